@@ -21,14 +21,14 @@ from anki.consts import *
 
 class Card(object):
 
-    def __init__(self, col, id=None):
+    def __init__(self, col, id=None, row=None):
         self.col = col
         self.timerStarted = None
         self._qa = None
         self._note = None
         if id:
             self.id = id
-            self.load()
+            self.load(row)
         else:
             # to flush, set nid, ord, and due
             self.id = timestampID(col.db, "cards")
@@ -46,7 +46,8 @@ class Card(object):
             self.flags = 0
             self.data = ""
 
-    def load(self):
+    def load(self, row=None):
+        "Load from the DB, or from ROW if it has already been fetched."
         (self.id,
          self.nid,
          self.did,
@@ -64,7 +65,7 @@ class Card(object):
          self.odue,
          self.odid,
          self.flags,
-         self.data) = self.col.db.first(
+         self.data) = row or self.col.db.first(
              "select * from cards where id = ?", self.id)
         self._qa = None
         self._note = None
@@ -76,6 +77,7 @@ class Card(object):
         if self.queue == 2 and self.odue and not self.col.decks.isDyn(self.did):
             runHook("odueInvalid")
         assert self.due < 4294967296
+        self.col.sched._cardChanging(self)
         self.col.db.execute(
             """
 insert or replace into cards values
@@ -98,6 +100,7 @@ insert or replace into cards values
             self.odid,
             self.flags,
             self.data)
+        self.col.sched._cardChanged()
         self.col.log(self)
 
     def flushSched(self):
@@ -107,6 +110,7 @@ insert or replace into cards values
         if self.queue == 2 and self.odue and not self.col.decks.isDyn(self.did):
             runHook("odueInvalid")
         assert self.due < 4294967296
+        self.col.sched._cardChanging(self)
         self.col.db.execute(
             """update cards set
 mod=?, usn=?, type=?, queue=?, due=?, ivl=?, factor=?, reps=?,
@@ -114,6 +118,7 @@ lapses=?, left=?, odue=?, odid=?, did=? where id = ?""",
             self.mod, self.usn, self.type, self.queue, self.due, self.ivl,
             self.factor, self.reps, self.lapses,
             self.left, self.odue, self.odid, self.did, self.id)
+        self.col.sched._cardChanged()
         self.col.log(self)
 
     def q(self, reload=False, browser=False):
@@ -11,6 +11,8 @@ import stat
 import datetime
 import copy
 import traceback
+import cPickle
+import multiprocessing
 
 from anki.lang import _, ngettext
 from anki.utils import ids2str, fieldChecksum, stripHTML, \
@@ -29,6 +31,7 @@ import anki.cards
 import anki.notes
 import anki.template
 import anki.find
+import anki.hooks
 
 
 defaultConf = {
@@ -59,11 +62,13 @@ class _Collection(object):
         self.log(self.path, anki.version)
         self.server = server
         self._lastSave = time.time()
+        self.lastFullCheck = 0
         self.clearUndo()
         self.media = MediaManager(self, server)
         self.models = ModelManager(self)
         self.decks = DeckManager(self)
         self.tags = TagManager(self)
+        self.findCache = anki.find.FindCache()
         self.load()
         if not self.crt:
             d = datetime.datetime.today()
@@ -101,6 +106,9 @@ conf, models, decks, dconf, tags from col""")
         self.models.load(models)
         self.decks.load(decks, dconf)
         self.tags.load(tags)
+        self.media._refs = None
+        self._searchIndex = bool(self.db.scalar(
+            "select 1 from sqlite_master where name = 'notesfts'"))
 
     def setMod(self):
         """Mark DB modified.
@@ -155,6 +163,8 @@ crt=?, mod=?, scm=?, dty=?, usn=?, ls=?, conf=?""",
                 self.db.execute("pragma journal_mode = delete")
             self.db.close()
             self.db = None
+            self.sched._clearDeckCounts()
+            self.findCache.clear()
             self.media.close()
             self._closeLog()
 
@@ -168,6 +178,8 @@ crt=?, mod=?, scm=?, dty=?, usn=?, ls=?, conf=?""",
 
     def rollback(self):
         self.db.rollback()
+        self.sched._clearDeckCounts()
+        self.findCache.clear()
         self.load()
         self.lock()
 
@@ -274,6 +286,8 @@ crt=?, mod=?, scm=?, dty=?, usn=?, ls=?, conf=?""",
         runHook("remNotes", self, ids)
         self._logRem(ids, REM_NOTE)
         self.db.execute("delete from notes where id in %s" % strids)
+        self.updateSearchIndex(ids)
+        self.media.updateRefs(ids)
 
     # Card creation
     ##########################################################################
@@ -325,32 +339,48 @@ crt=?, mod=?, scm=?, dty=?, usn=?, ls=?, conf=?""",
         now = intTime()
         rem = []
         usn = self.usn()
+        # notes of a model with the same non-empty fields share their
+        # available ordinals, and decks only need to be checked once
+        avails = {}
+        deckIds = {}
         for nid, mid, flds in self.db.execute(
             "select id, mid, flds from notes where id in "+snids):
             model = self.models.get(mid)
-            avail = self.models.availOrds(model, flds)
+            if model['type'] == MODEL_STD:
+                key = (mid, self.models._fieldMask(flds))
+                if key not in avails:
+                    avails[key] = self.models._availFromMask(model, key[1])
+                avail = avails[key]
+            else:
+                avail = self.models.availOrds(model, flds)
             did = dids.get(nid) or model['did']
             # add any missing cards
             for t in self._tmplsFromOrds(model, avail):
                 doHave = nid in have and t['ord'] in have[nid]
                 if not doHave:
-                    # check deck is not a cram deck
                     did = t['did'] or did
-                    if self.decks.isDyn(did):
-                        did = 1
-                    # if the deck doesn't exist, use default instead
-                    did = self.decks.get(did)['id']
-                    # we'd like to use the same due# as sibling cards, but we
-                    # can't retrieve that quickly, so we give it a new id
-                    # instead
-                    data.append((ts, nid, did, t['ord'],
-                                 now, usn, self.nextID("pos")))
+                    if did not in deckIds:
+                        # check deck is not a cram deck
+                        if self.decks.isDyn(did):
+                            deckIds[did] = 1
+                        else:
+                            # if the deck doesn't exist, use default instead
+                            deckIds[did] = self.decks.get(did)['id']
+                    did = deckIds[did]
+                    data.append([ts, nid, did, t['ord'], now, usn])
                     ts += 1
             # note any cards that need removing
             if nid in have:
                 for ord, id in have[nid].items():
                     if ord not in avail:
                         rem.append(id)
+        # we'd like to use the same due# as sibling cards, but we can't
+        # retrieve that quickly, so we give each card a new position instead
+        if data:
+            pos = self.nextID("pos", inc=False)
+            for c, row in enumerate(data):
+                row.append(pos + c)
+            self.conf['nextPos'] = pos + len(data)
         # bulk update
         self.db.executemany("""
 insert into cards values (?,?,?,?,?,?,0,0,?,0,0,0,0,0,0,0,0,"")""",
@@ -467,11 +497,101 @@ where c.nid = n.id and c.id in %s group by nid""" % ids2str(cids)):
                       nid))
         # apply, relying on calling code to bump usn+mod
         self.db.executemany("update notes set sfld=?, csum=? where id=?", r)
+        self.updateSearchIndex(nids)
+        self.media.updateRefs(nids)
+
+    # Search index
+    ##########################################################################
+    # An optional trigram index of the note fields, which the finder uses for
+    # substring searches instead of scanning the notes table.
+
+    def hasSearchIndex(self):
+        return self._searchIndex
+
+    def enableSearchIndex(self):
+        "Create and fill the search index. False if SQLite can't support it."
+        if not self._searchIndex:
+            try:
+                self.db.execute("""
+create virtual table notesfts using fts5 (sfld, flds, tokenize='trigram')""")
+            except:
+                # sqlite built without fts5 or too old for trigrams
+                return False
+            self._searchIndex = True
+            self.rebuildSearchIndex()
+        return True
+
+    def disableSearchIndex(self):
+        if self._searchIndex:
+            self.db.execute("drop table notesfts")
+            self._searchIndex = False
+
+    def rebuildSearchIndex(self):
+        if not self._searchIndex:
+            return
+        self.db.execute("delete from notesfts")
+        self.db.execute("""
+insert into notesfts (rowid, sfld, flds) select id, sfld, flds from notes""")
+
+    def updateSearchIndex(self, nids):
+        "Reindex notes after they've been modified or deleted."
+        if not self._searchIndex:
+            return
+        snids = ids2str(nids)
+        self.db.execute("delete from notesfts where rowid in "+snids)
+        self.db.execute("""
+insert into notesfts (rowid, sfld, flds) select id, sfld, flds from notes
+where id in """+snids)
+
+    # Row counts
+    ##########################################################################
+    # Counts of the larger tables, kept current by temporary triggers so the
+    # sync sanity check doesn't need to scan them.
+
+    countedTables = ("cards", "notes", "revlog", "graves")
+
+    def prepareRowCounts(self):
+        """Start maintaining row counts on this connection if not already.
+As sqlite commits before creating tables, call when no changes are pending."""
+        if self.db.scalar("""
+select 1 from sqlite_temp_master where name = 'rowcounts'"""):
+            return
+        mod = self.db.mod
+        # make 'insert or replace' fire the delete triggers
+        self.db.execute("pragma recursive_triggers = on")
+        self.db.execute("""
+create temp table rowcounts (tbl text primary key, n integer not null)""")
+        for t in self.countedTables:
+            self.db.execute("""
+insert into rowcounts values (?, (select count() from %s))""" % t, t)
+        # creating the triggers commits the counts above
+        for t in self.countedTables:
+            for op, delta in (("insert", "+ 1"), ("delete", "- 1")):
+                self.db.execute("""
+create temp trigger rowcounts_%s_%s after %s on main.%s begin
+update rowcounts set n = n %s where tbl = '%s'; end""" % (
+                    t, op, op, t, delta, t))
+        self.db.mod = mod
+
+    def rowCounts(self):
+        """Return {table: rows} for the tables in countedTables. The tables are
+counted directly if prepareRowCounts() hasn't been called."""
+        if self.db.scalar("""
+select 1 from sqlite_temp_master where name = 'rowcounts'"""):
+            return dict(self.db.all("select tbl, n from rowcounts"))
+        return dict((t, self.db.scalar("select count() from %s" % t))
+                    for t in self.countedTables)
 
     # Q/A generation
     ##########################################################################
 
     def renderQA(self, ids=None, type="card"):
+        return list(self.iterRenderQA(ids, type))
+
+    def iterRenderQA(self, ids=None, type="card", chunk=1000, processes=0):
+        """Yield rendered Q/A like renderQA(), fetching CHUNK rows at a time.
+If PROCESSES is non-zero, templates are rendered in a pool of that many
+processes. Results are always returned in order."""
         # gather metadata
         if type == "card":
             where = "and c.id in " + ids2str(ids)
@@ -483,12 +603,78 @@ where c.nid = n.id and c.id in %s group by nid""" % ids2str(cids)):
             where = ""
         else:
             raise Exception()
-        return [self._renderQA(row)
-                for row in self._qaData(where)]
+        pool = None
+        if processes:
+            fmods = self._templateFilters()
+            if fmods is not None:
+                pool = multiprocessing.Pool(
+                    processes, _initRenderProcess, (fmods,))
+        try:
+            cur = self._qaData(where)
+            while 1:
+                rows = cur.fetchmany(chunk)
+                if not rows:
+                    break
+                if pool:
+                    for d in self._renderQAChunk(rows, pool):
+                        yield d
+                else:
+                    for row in rows:
+                        yield self._renderQA(row)
+        finally:
+            if pool:
+                pool.terminate()
+
+    def _templateFilters(self):
+        "The fmod_ hooks for pool processes, or None if they can't be sent."
+        fmods = dict((k, v) for (k, v) in anki.hooks._hooks.items()
+                     if k.startswith("fmod_"))
+        try:
+            cPickle.dumps(fmods, 2)
+        except Exception:
+            return None
+        return fmods
+
+    def _renderQAChunk(self, rows, pool):
+        "Like _renderQA() on each of ROWS, rendering templates in POOL."
+        # [data, fields, model, template, result]
+        todo = []
+        for data in rows:
+            todo.append(list(self._qaFields(data)) + [dict(id=data[0])])
+            todo[-1].insert(0, data)
+        for type in "q", "a":
+            jobs = []
+            for t in todo:
+                data, fields, model, template, d = t
+                format = self._qaFormat(type, template[type+'fmt'], data[4])
+                if type == "a":
+                    fields['FrontSide'] = stripSounds(d['q'])
+                t[1] = runFilter("mungeFields", fields, model, data, self)
+                jobs.append((format, t[1]))
+            htmls = pool.map(_renderTemplate, jobs)
+            for (data, fields, model, template, d), html in zip(todo, htmls):
+                self._qaFinish(d, type, html, fields, model, data)
+        return [t[4] for t in todo]
 
     def _renderQA(self, data, qfmt=None, afmt=None):
         "Returns hash of id, question, answer."
         # data is [cid, nid, mid, did, ord, tags, flds]
+        fields, model, template = self._qaFields(data)
+        # render q & a
+        d = dict(id=data[0])
+        qfmt = qfmt or template['qfmt']
+        afmt = afmt or template['afmt']
+        for (type, format) in (("q", qfmt), ("a", afmt)):
+            format = self._qaFormat(type, format, data[4])
+            if type == "a":
+                fields['FrontSide'] = stripSounds(d['q'])
+            fields = runFilter("mungeFields", fields, model, data, self)
+            html = anki.template.render(format, fields)
+            self._qaFinish(d, type, html, fields, model, data)
+        return d
+
+    def _qaFields(self, data):
+        "Returns (fields, model, template) for a _qaData() row."
         # unpack fields and create dict
         flist = splitFields(data[6])
         fields = {}
@@ -504,31 +690,26 @@ where c.nid = n.id and c.id in %s group by nid""" % ids2str(cids)):
             template = model['tmpls'][0]
         fields['Card'] = template['name']
         fields['c%d' % (data[4]+1)] = "1"
-        # render q & a
-        d = dict(id=data[0])
-        qfmt = qfmt or template['qfmt']
-        afmt = afmt or template['afmt']
-        for (type, format) in (("q", qfmt), ("a", afmt)):
-            if type == "q":
-                format = re.sub("{{(?!type:)(.*?)cloze:", r"{{\1cq-%d:" % (data[4]+1), format)
-                format = format.replace("<%cloze:", "<%%cq:%d:" % (
-                    data[4]+1))
-            else:
-                format = re.sub("{{(.*?)cloze:", r"{{\1ca-%d:" % (data[4]+1), format)
-                format = format.replace("<%cloze:", "<%%ca:%d:" % (
-                    data[4]+1))
-                fields['FrontSide'] = stripSounds(d['q'])
-            fields = runFilter("mungeFields", fields, model, data, self)
-            html = anki.template.render(format, fields)
-            d[type] = runFilter(
-                "mungeQA", html, type, fields, model, data, self)
-            # empty cloze?
-            if type == 'q' and model['type'] == MODEL_CLOZE:
-                if not self.models._availClozeOrds(model, data[6], False):
-                    d['q'] += ("<p>" + _(
-                "Please edit this note and add some cloze deletions. (%s)") % (
-                "<a href=%s#cloze>%s</a>" % (HELP_SITE, _("help"))))
-        return d
+        return fields, model, template
+
+    def _qaFormat(self, type, format, ord):
+        "Point cloze tags in FORMAT at cloze ORD."
+        if type == "q":
+            format = re.sub("{{(?!type:)(.*?)cloze:", r"{{\1cq-%d:" % (ord+1), format)
+            return format.replace("<%cloze:", "<%%cq:%d:" % (ord+1))
+        else:
+            format = re.sub("{{(.*?)cloze:", r"{{\1ca-%d:" % (ord+1), format)
+            return format.replace("<%cloze:", "<%%ca:%d:" % (ord+1))
+
+    def _qaFinish(self, d, type, html, fields, model, data):
+        d[type] = runFilter(
+            "mungeQA", html, type, fields, model, data, self)
+        # empty cloze?
+        if type == 'q' and model['type'] == MODEL_CLOZE:
+            if not self.models._availClozeOrds(model, data[6], False):
+                d['q'] += ("<p>" + _(
+            "Please edit this note and add some cloze deletions. (%s)") % (
+            "<a href=%s#cloze>%s</a>" % (HELP_SITE, _("help"))))
 
     def _qaData(self, where=""):
         "Return [cid, nid, mid, did, ord, tags, flds] db query"
@@ -772,6 +953,10 @@ select id from cards where odid > 0 and did in %s""" % ids2str(dids))
         # field cache
         for m in self.models.all():
             self.updateFieldCache(self.models.nids(m))
+        self.rebuildSearchIndex()
+        # media references
+        if self.media.haveRefs():
+            self.media.rebuildRefs()
         # new cards can't have a due position > 32 bits
         self.db.execute("""
 update cards set due = 1000000, mod = ?, usn = ? where due > 1000000
@@ -835,3 +1020,14 @@ and queue = 0""", intTime(), self.usn())
 
     def _closeLog(self):
         self._logHnd = None
+
+# Rendering in other processes
+##########################################################################
+
+def _initRenderProcess(fmods):
+    for hook, funcs in fmods.items():
+        for func in funcs:
+            anki.hooks.addHook(hook, func)
+
+def _renderTemplate(args):
+    return anki.template.render(*args)
@@ -94,6 +94,7 @@ class DeckManager(object):
         self.decks = json.loads(decks)
         self.dconf = json.loads(dconf)
         self.changed = False
+        self._buildIndex()
 
     def save(self, g=None):
         "Can be called with either a deck or a deck configuration."
@@ -115,9 +116,9 @@ class DeckManager(object):
     def id(self, name, create=True, type=defaultDeck):
         "Add a deck with NAME. Reuse deck if already exists. Return id as int."
         name = name.replace('"', '')
-        for id, g in self.decks.items():
-            if g['name'].lower() == name.lower():
-                return int(id)
+        ids = self._byName.get(name.lower())
+        if ids:
+            return int(ids[0])
         if not create:
             return None
         g = copy.deepcopy(type)
@@ -131,6 +132,7 @@ class DeckManager(object):
                 break
         g['id'] = id
         self.decks[str(id)] = g
+        self._addToIndex(g)
         self.save(g)
         self.maybeAddToActive()
         runHook("newDeck")
@@ -143,7 +145,9 @@ class DeckManager(object):
             # child of an existing deck then it needs to be renamed
             deck = self.get(did)
             if '::' in deck['name']:
+                self._remFromIndex(deck)
                 deck['name'] = _("Default")
+                self._addToIndex(deck)
                 self.save(deck)
             return
         # log the removal regardless of whether we have the deck or not
@@ -172,6 +176,7 @@ class DeckManager(object):
                     "select id from cards where did=? or odid=?", did, did)
                 self.col.remCards(cids)
         # delete the deck and add a grave
+        self._remFromIndex(deck)
         del self.decks[str(did)]
         # ensure we have an active deck
         if did in self.active():
@@ -215,13 +220,16 @@ class DeckManager(object):
 
     def byName(self, name):
         "Get deck with NAME."
-        for m in self.decks.values():
-            if m['name'] == name:
-                return m
+        for id in self._byName.get(name.lower(), ()):
+            if self.decks[id]['name'] == name:
+                return self.decks[id]
 
     def update(self, g):
         "Add or update an existing deck. Used for syncing and merging."
+        if str(g['id']) in self.decks:
+            self._remFromIndex(self.decks[str(g['id'])])
         self.decks[str(g['id'])] = g
+        self._addToIndex(g)
         self.maybeAddToActive()
         # mark registry changed, but don't bump mod time
         self.save()
@@ -239,13 +247,17 @@ class DeckManager(object):
             if self.byName(newParent)['dyn']:
                 raise DeckRenameError(_("A filtered deck cannot have subdecks."))
         # rename children
-        for grp in self.all():
-            if grp['name'].startswith(g['name'] + "::"):
-                grp['name'] = grp['name'].replace(g['name']+ "::",
-                                                  newName + "::", 1)
-                self.save(grp)
+        for name, id in self.children(g['id']):
+            grp = self.get(id)
+            self._remFromIndex(grp)
+            grp['name'] = grp['name'].replace(g['name']+ "::",
+                                              newName + "::", 1)
+            self._addToIndex(grp)
+            self.save(grp)
         # adjust name
+        self._remFromIndex(g)
         g['name'] = newName
+        self._addToIndex(g)
         # ensure we have parents again, as we may have renamed parent->child
         newName = self._ensureParents(newName)
         self.save(g)
@@ -446,11 +458,8 @@ class DeckManager(object):
     def children(self, did):
         "All children of did, as (name, id)."
         name = self.get(did)['name']
-        actv = []
-        for g in self.all():
-            if g['name'].startswith(name + "::"):
-                actv.append((g['name'], g['id']))
-        return actv
+        return [(self.decks[id]['name'], self.decks[id]['id'])
+                for id in self._children.get(name, ())]
 
     def parents(self, did):
         "All parents of did."
@@ -463,9 +472,48 @@ class DeckManager(object):
                 parents.append(parents[-1] + "::" + part)
         # convert to objects
         for c, p in enumerate(parents):
-            parents[c] = self.get(self.id(p))
+            ids = self._byName.get(p.lower())
+            if ids:
+                parents[c] = self.decks[ids[0]]
+            else:
+                parents[c] = self.get(self.id(p))
         return parents
 
+    # Hierarchy index
+    ##########################################################################
+
+    # _byName maps lowercased names to deck ids, for id(). _children maps
+    # each name prefix to the ids of all decks below it, which is what
+    # children() used to find by checking every deck with startswith().
+
+    def _buildIndex(self):
+        self._byName = {}
+        self._children = {}
+        for g in self.decks.values():
+            self._addToIndex(g)
+
+    def _prefixes(self, name):
+        path = self._path(name)
+        return ["::".join(path[:i]) for i in range(1, len(path))]
+
+    def _addToIndex(self, g):
+        id = str(g['id'])
+        self._byName.setdefault(g['name'].lower(), []).append(id)
+        for p in self._prefixes(g['name']):
+            self._children.setdefault(p, []).append(id)
+
+    def _remFromIndex(self, g):
+        id = str(g['id'])
+        def rem(d, key):
+            ids = d.get(key)
+            if ids and id in ids:
+                ids.remove(id)
+                if not ids:
+                    del d[key]
+        rem(self._byName, g['name'].lower())
+        for p in self._prefixes(g['name']):
+            rem(self._children, p)
+
     # Sync handling
     ##########################################################################
 
@@ -193,11 +193,8 @@ class AnkiExporter(Exporter):
         media = {}
         self.mediaDir = self.src.media.dir()
         if self.includeMedia:
-            for row in notedata:
-                flds = row[6]
-                mid = row[2]
-                for file in self.src.media.filesInStr(mid, flds):
-                    media[file] = True
+            for file in self.src.media.filesInNotes(nids.keys()):
+                media[file] = True
             if self.mediaDir:
                 for fname in os.listdir(self.mediaDir):
                     if fname.startswith("_"):
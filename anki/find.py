@@ -31,42 +31,92 @@ class Finder(object):
             dupe=self._findDupes,
         )
         self.search['is'] = self._findCardState
+        self._builtin = self.search.copy()
         runHook("search", self.search)
 
     def findCards(self, query, order=False):
         "Return a list of card ids for QUERY."
-        tokens = self._tokenize(query)
-        preds, args = self._where(tokens)
-        if preds is None:
-            return []
-        order, rev = self._order(order)
-        sql = self._query(preds, order)
-        try:
-            res = self.col.db.list(sql, *args)
-        except:
-            # invalid grouping
-            return []
+        sql, args, rev = self._compile(query, order)
+        res = self._run(sql, args)
         if rev:
             res.reverse()
         return res
 
     def findNotes(self, query):
+        sql, args, rev = self._compile(query, notes=True)
+        return self._run(sql, args)
+
+    # Caching
+    ######################################################################
+    # Compiled queries are reused while the things they were built from are
+    # unchanged, and results while the database hasn't been written to.
+
+    # commands that only depend on the query text and the current day
+    _pureCmds = ("added", "cid", "is", "mid", "nid", "prop", "rated", "tag")
+
+    def _compile(self, query, order=False, notes=False):
+        "Return (sql, args, reverse) for QUERY."
+        sched = self.col.sched
+        key = (query, order, notes, self.col.scm, sched.today, sched.dayCutoff,
+               self.col.conf['sortType'], self.col.conf['sortBackwards'],
+               self.col.hasSearchIndex())
+        cache = self.col.findCache
+        if key in cache.queries:
+            return cache.queries[key]
         tokens = self._tokenize(query)
         preds, args = self._where(tokens)
         if preds is None:
-            return []
-        if preds:
-            preds = "(" + preds + ")"
-        else:
-            preds = "1"
-        sql = """
+            ret = None, None, False
+        elif notes:
+            if preds:
+                preds = "(" + preds + ")"
+            else:
+                preds = "1"
+            sql = """
 select distinct(n.id) from cards c, notes n where c.nid=n.id and """+preds
+            ret = sql, args, False
+        else:
+            order, rev = self._order(order)
+            ret = self._query(preds, order), args, rev
+        if self._cacheable(tokens):
+            cache.add(cache.queries, key, ret)
+        return ret
+
+    def _cacheable(self, tokens):
+        for token in tokens:
+            if ":" not in token:
+                continue
+            cmd, val = token.split(":", 1)
+            cmd = cmd.lower()
+            if cmd not in self.search:
+                # field search
+                return False
+            if self.search[cmd] != self._builtin.get(cmd):
+                # replaced by an add-on
+                return False
+            if cmd == "deck":
+                # names may be changed
+                if val not in ("*", "filtered"):
+                    return False
+            elif cmd not in self._pureCmds:
+                return False
+        return True
+
+    def _run(self, sql, args):
+        if sql is None:
+            return []
+        cache = self.col.findCache
+        changes = self.col.db.totalChanges()
+        key = (sql, tuple(args), changes)
+        if key in cache.results:
+            return list(cache.results[key])
         try:
             res = self.col.db.list(sql, *args)
         except:
             # invalid grouping
             return []
-        return res
+        cache.addResult(key, res, changes)
+        return list(res)
 
     # Tokenizing
     ######################################################################
@@ -325,10 +375,20 @@ select distinct(n.id) from cards c, notes n where c.nid=n.id and """+preds
         q.append("(%s %s %s)" % (prop, cmp, val))
         return " and ".join(q)
 
+    def _useIndex(self, val):
+        # the index can't be used with an escape character, so
+        # escaped wildcards are left to the notes table
+        return self.col.hasSearchIndex() and "\\" not in val
+
     def _findText(self, val, args):
         val = val.replace("*", "%")
         args.append("%"+val+"%")
         args.append("%"+val+"%")
+        if self._useIndex(val):
+            # a union lets both halves use the index
+            return """
+n.id in (select rowid from notesfts where sfld like ? union
+select rowid from notesfts where flds like ?)"""
         return "(n.sfld like ? escape '\\' or n.flds like ? escape '\\')"
 
     def _findNids(self, (val, args)):
@@ -423,11 +483,14 @@ select distinct(n.id) from cards c, notes n where c.nid=n.id and """+preds
             return
         # gather nids
         regex = re.escape(val).replace("\\_", ".").replace("\\%", ".*")
+        if self._useIndex(val):
+            lim = "id in (select rowid from notesfts where flds like ?)"
+        else:
+            lim = "flds like ? escape '\\'"
         nids = []
         for (id,mid,flds) in self.col.db.execute("""
 select id, mid, flds from notes
-where mid in %s and flds like ? escape '\\'""" % (
-                         ids2str(mods.keys())),
+where mid in %s and %s""" % (ids2str(mods.keys()), lim),
                          "%"+val+"%"):
             flds = splitFields(flds)
             ord = mods[str(mid)][1]
@@ -456,6 +519,43 @@ where mid in %s and flds like ? escape '\\'""" % (
                 nids.append(nid)
         return "n.id in %s" % ids2str(nids)
 
+class FindCache(object):
+    """Compiled searches and their results, shared by a collection's finders.
+Results are only kept until the db changes, and no more than IDLIMIT ids are
+held across all of them."""
+
+    def __init__(self, limit=100, idLimit=100000):
+        self.limit = limit
+        self.idLimit = idLimit
+        self.clear()
+
+    def clear(self):
+        self.queries = {}
+        self.results = {}
+        self.resultIds = 0
+        self.changes = None
+
+    def add(self, cache, key, val):
+        if len(cache) >= self.limit:
+            cache.clear()
+        cache[key] = val
+
+    def addResult(self, key, res, changes):
+        "Cache RES, found when the db had seen CHANGES changes."
+        if changes != self.changes:
+            # older results can't be looked up any more
+            self.results = {}
+            self.resultIds = 0
+            self.changes = changes
+        if len(res) > self.idLimit:
+            return
+        if (len(self.results) >= self.limit or
+            self.resultIds + len(res) > self.idLimit):
+            self.results = {}
+            self.resultIds = 0
+        self.results[key] = res
+        self.resultIds += len(res)
+
 # Find and replace
 ##########################################################################
 
@@ -3,9 +3,11 @@
 # License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
 
 import os
+import shutil
 import unicodedata
 from anki import Collection
-from anki.utils import intTime, splitFields, joinFields, incGuid
+from anki.utils import intTime, splitFields, joinFields, incGuid, \
+    checksumFile, CHUNK_SIZE
 from anki.importing.base import Importer
 from anki.lang import _
 from anki.lang import ngettext
@@ -20,6 +22,8 @@ class Anki2Importer(Importer):
     deckPrefix = None
     allowUpdate = True
     dupeOnSchemaChange = False
+    # compact the collection afterwards
+    vacuum = True
 
     def run(self, media=None):
         self._prepareFiles()
@@ -37,49 +41,83 @@ class Anki2Importer(Importer):
 
     def _import(self):
         self._decks = {}
-        if self.deckPrefix:
-            id = self.dst.decks.id(self.deckPrefix)
-            self.dst.decks.select(id)
-        self._prepareTS()
-        self._prepareModels()
-        self._importNotes()
-        self._importCards()
-        self._importStaticMedia()
-        self._postImport()
-        self.dst.db.execute("vacuum")
+        self._attach()
+        try:
+            if self.deckPrefix:
+                id = self.dst.decks.id(self.deckPrefix)
+                self.dst.decks.select(id)
+            self._prepareTS()
+            self._prepareModels()
+            self._importNotes()
+            self._importCards()
+            self._importStaticMedia()
+            self._postImport()
+        finally:
+            self._detach()
+        if self.vacuum:
+            self.dst.db.execute("vacuum")
         self.dst.db.execute("analyze")
 
+    # The source collection is attached to the destination, so notes and
+    # cards can be matched up with joins instead of loading the whole
+    # destination into memory. As sqlite commits before attaching or creating
+    # tables, this is done before anything is imported.
+
+    def _attach(self):
+        self.dst.db.execute("attach ? as src", self.file)
+        # src id -> dst id of each note and each added card
+        for t in "impnotes", "impcards":
+            self.dst.db.execute("""
+create temp table %s (sid integer primary key, id integer not null)""" % t)
+
+    def _detach(self):
+        for t in "impnotes", "impcards":
+            self.dst.db.execute("drop table if exists temp.%s" % t)
+        self.dst.db.execute("detach src")
+
+    def _freeId(self, table, id, taken):
+        "Return the first id from ID in steps of 999 not in TABLE or TAKEN."
+        while id in taken or self.dst.db.scalar(
+            "select 1 from %s where id = ?" % table, id):
+            id += 999
+        return id
+
     # Notes
     ######################################################################
 
     def _importNotes(self):
-        # build guid -> (id,mod,mid) hash & map of existing note ids
+        # guid -> (id,mod,mid) of destination notes we've come across
         self._notes = {}
-        existing = {}
-        for id, guid, mod, mid in self.dst.db.execute(
-            "select id, guid, mod, mid from notes"):
-            self._notes[guid] = (id, mod, mid)
-            existing[id] = True
-        # we may need to rewrite the guid if the model schemas don't match,
-        # so we need to keep track of the changes for the card import stage
-        self._changedGuids = {}
+        # ids of added notes, and source notes processed
+        added = set()
+        seen = set()
         # iterate over source collection
         add = []
         update = []
         dirty = []
+        mapping = []
         usn = self.dst.usn()
         dupes = 0
         dupesIgnored = []
-        for note in self.src.db.execute(
-            "select * from notes"):
+        for row in self.dst.db.execute("""
+select s.*, d.id, d.mod, d.mid, x.id is not null from src.notes s
+left join main.notes d on d.guid = s.guid
+left join main.notes x on x.id = s.id"""):
             # turn the db result into a mutable list
-            note = list(note)
+            note = list(row[:11])
+            sid = note[0]
+            if sid in seen:
+                # the destination has more than one note with this guid
+                continue
+            seen.add(sid)
+            if row[11] is not None:
+                self._notes[note[GUID]] = tuple(row[11:14])
             shouldAdd = self._uniquifyNote(note)
             if shouldAdd:
                 # ensure id is unique
-                while note[0] in existing:
-                    note[0] += 999
-                existing[note[0]] = True
+                if row[14] or note[0] in added:
+                    note[0] = self._freeId("notes", note[0], added)
+                added.add(note[0])
                 # bump usn
                 note[4] = usn
                 # update media references in case of dupes
@@ -108,6 +146,8 @@ class Anki2Importer(Importer):
                                 self.col.models.get(oldMid)['name'],
                                 note[6].replace("\x1f", ",")
                             ))
+            # cards are imported into whichever note the guid ended up at
+            mapping.append((sid, self._notes[note[GUID]][0]))
         if dupes:
             up = len(update)
             self.log.append(_("Updated %(a)d of %(b)d existing notes.") % dict(
@@ -126,9 +166,21 @@ class Anki2Importer(Importer):
         self.dst.db.executemany(
             "insert or replace into notes values (?,?,?,?,?,?,?,?,?,?,?)",
             update)
+        self.dst.db.executemany(
+            "insert into impnotes values (?,?)", mapping)
         self.dst.updateFieldCache(dirty)
         self.dst.tags.registerNotes(dirty)
 
+    def _dstNote(self, guid):
+        "(id,mod,mid) of the destination note with GUID, or None."
+        if guid not in self._notes:
+            r = self.dst.db.first(
+                "select id, mod, mid from notes where guid = ?", guid)
+            if not r:
+                return None
+            self._notes[guid] = tuple(r)
+        return self._notes[guid]
+
     # determine if note is a duplicate, and adjust mid and/or guid as required
     # returns true if note should be added
     def _uniquifyNote(self, note):
@@ -148,12 +200,12 @@ class Anki2Importer(Importer):
             return False
         while True:
             note[GUID] = incGuid(note[GUID])
-            self._changedGuids[origGuid] = note[GUID]
+            existing = self._dstNote(note[GUID])
             # if we don't have an existing guid, we can add
-            if note[GUID] not in self._notes:
+            if not existing:
                 return True
             # if the existing guid shares the same mid, we can reuse
-            if dstMid == self._notes[note[GUID]][MID]:
+            if dstMid == existing[MID]:
                 return False
 
     # Models
@@ -247,44 +299,27 @@ class Anki2Importer(Importer):
     ######################################################################
 
     def _importCards(self):
-        # build map of (guid, ord) -> cid and used id cache
-        self._cards = {}
-        existing = {}
-        for guid, ord, cid in self.dst.db.execute(
-            "select f.guid, c.ord, c.id from cards c, notes f "
-            "where c.nid = f.id"):
-            existing[cid] = True
-            self._cards[(guid, ord)] = cid
-        # loop through src
+        # the cards that the destination notes don't already have
         cards = []
-        revlog = []
-        cnt = 0
+        mapping = []
+        # ids of added cards
+        added = set()
         usn = self.dst.usn()
         aheadBy = self.src.sched.today - self.dst.sched.today
-        for card in self.src.db.execute(
-            "select f.guid, f.mid, c.* from cards c, notes f "
-            "where c.nid = f.id"):
-            guid = card[0]
-            if guid in self._changedGuids:
-                guid = self._changedGuids[guid]
-            # does the card's note exist in dst col?
-            if guid not in self._notes:
-                continue
-            dnid = self._notes[guid]
-            # does the card already exist in the dst col?
-            ord = card[5]
-            if (guid, ord) in self._cards:
-                # fixme: in future, could update if newer mod time
-                continue
-            # doesn't exist. strip off note info, and save src id for later
-            card = list(card[2:])
+        for row in self.dst.db.execute("""
+select c.*, m.id, x.id is not null from src.cards c
+join impnotes m on m.sid = c.nid
+left join main.cards d on d.nid = m.id and d.ord = c.ord
+left join main.cards x on x.id = c.id
+where d.id is null"""):
+            card = list(row[:18])
             scid = card[0]
             # ensure the card id is unique
-            while card[0] in existing:
-                card[0] += 999
-            existing[card[0]] = True
+            if row[19] or card[0] in added:
+                card[0] = self._freeId("cards", card[0], added)
+            added.add(card[0])
             # update cid, nid, etc
-            card[1] = self._notes[guid][0]
+            card[1] = row[18]
             card[2] = self._did(card[2])
             card[4] = intTime()
             card[5] = usn
@@ -307,19 +342,18 @@ class Anki2Importer(Importer):
                 if card[6] == 1:
                     card[6] = 0
             cards.append(card)
-            # we need to import revlog, rewriting card ids and bumping usn
-            for rev in self.src.db.execute(
-                "select * from revlog where cid = ?", scid):
-                rev = list(rev)
-                rev[1] = card[0]
-                rev[2] = self.dst.usn()
-                revlog.append(rev)
-            cnt += 1
+            mapping.append((scid, card[0]))
         # apply
         self.dst.db.executemany("""
 insert or ignore into cards values (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)""", cards)
-        self.dst.db.executemany("""
-insert or ignore into revlog values (?,?,?,?,?,?,?,?,?)""", revlog)
+        self.dst.db.executemany(
+            "insert into impcards values (?,?)", mapping)
+        # copy revlog, rewriting card ids and bumping usn
+        self.dst.db.execute("""
+insert or ignore into revlog select r.id, m.id, ?, r.ease, r.ivl, r.lastIvl,
+r.factor, r.time, r.type from src.revlog r join impcards m on m.sid = r.cid""",
+                            usn)
+        cnt = len(cards)
         self.log.append(ngettext("%d card imported.", "%d cards imported.", cnt) % cnt)
 
     # Media
@@ -335,41 +369,59 @@ insert or ignore into revlog values (?,?,?,?,?,?,?,?,?)""", revlog)
             return
         for fname in os.listdir(dir):
             if fname.startswith("_") and not self.dst.media.have(fname):
-                self._writeDstMedia(fname, self._srcMediaData(fname))
+                self._writeDstMedia(fname, self._srcMediaFile(fname))
 
-    def _mediaData(self, fname, dir=None):
+    def _mediaFile(self, fname, dir=None):
         if not dir:
             dir = self.src.media.dir()
         path = os.path.join(dir, fname)
         try:
-            return open(path, "rb").read()
+            if os.path.getsize(path):
+                return open(path, "rb")
         except (IOError, OSError):
             return
 
-    def _srcMediaData(self, fname):
-        "Data for FNAME in src collection."
-        return self._mediaData(fname, self.src.media.dir())
+    def _srcMediaFile(self, fname):
+        "Open file for FNAME in src collection, or None if missing or empty."
+        return self._mediaFile(fname, self.src.media.dir())
 
-    def _dstMediaData(self, fname):
-        "Data for FNAME in dst collection."
-        return self._mediaData(fname, self.dst.media.dir())
+    def _dstMediaFile(self, fname):
+        "Open file for FNAME in dst collection, or None if missing or empty."
+        return self._mediaFile(fname, self.dst.media.dir())
 
-    def _writeDstMedia(self, fname, data):
+    def _mediaChecksum(self, file):
+        "Checksum an open file from the above, closing it."
+        if not file:
+            return
+        try:
+            return checksumFile(file)
+        finally:
+            file.close()
+
+    def _writeDstMedia(self, fname, file):
+        "Copy an open file from the above to FNAME in dst, closing it."
+        if not file:
+            return
         path = os.path.join(self.dst.media.dir(),
                             unicodedata.normalize("NFC", fname))
         try:
-            open(path, "wb").write(data)
+            out = open(path, "wb")
         except (OSError, IOError):
             # the user likely used subdirectories
-            pass
+            file.close()
+            return
+        try:
+            shutil.copyfileobj(file, out, CHUNK_SIZE)
+        finally:
+            out.close()
+            file.close()
 
     def _mungeMedia(self, mid, fields):
         fields = splitFields(fields)
         def repl(match):
             fname = match.group("fname")
-            srcData = self._srcMediaData(fname)
-            dstData = self._dstMediaData(fname)
-            if not srcData:
+            srcCsum = self._mediaChecksum(self._srcMediaFile(fname))
+            if not srcCsum:
                 # file was not in source, ignore
                 return match.group(0)
             # if model-local file exists from a previous import, use that
@@ -378,13 +430,14 @@ insert or ignore into revlog values (?,?,?,?,?,?,?,?,?)""", revlog)
             if self.dst.media.have(lname):
                 return match.group(0).replace(fname, lname)
             # if missing or the same, pass unmodified
-            elif not dstData or srcData == dstData:
+            dstCsum = self._mediaChecksum(self._dstMediaFile(fname))
+            if not dstCsum or srcCsum == dstCsum:
                 # need to copy?
-                if not dstData:
-                    self._writeDstMedia(fname, srcData)
+                if not dstCsum:
+                    self._writeDstMedia(fname, self._srcMediaFile(fname))
                 return match.group(0)
             # exists but does not match, so we need to dedupe
-            self._writeDstMedia(lname, srcData)
+            self._writeDstMedia(lname, self._srcMediaFile(fname))
             return match.group(0).replace(fname, lname)
         for i in range(len(fields)):
             fields[i] = self.dst.media.transformNames(fields[i], repl)
@@ -3,8 +3,9 @@
 # License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
 
 import zipfile, os
+import shutil
 import unicodedata
-from anki.utils import tmpfile, json
+from anki.utils import tmpfile, json, CHUNK_SIZE
 from anki.importing.anki2 import Anki2Importer
 
 class AnkiPackageImporter(Anki2Importer):
@@ -12,9 +13,8 @@ class AnkiPackageImporter(Anki2Importer):
     def run(self):
         # extract the deck from the zip file
         self.zip = z = zipfile.ZipFile(self.file)
-        col = z.read("collection.anki2")
         colpath = tmpfile(suffix=".anki2")
-        open(colpath, "wb").write(col)
+        self._extract("collection.anki2", colpath)
         self.file = colpath
         # we need the media dict in advance, and we'll need a map of fname ->
         # number to use during the import
@@ -30,9 +30,21 @@ class AnkiPackageImporter(Anki2Importer):
             path = os.path.join(self.col.media.dir(),
                                 unicodedata.normalize("NFC", file))
             if not os.path.exists(path):
-                open(path, "wb").write(z.read(c))
+                self._extract(c, path)
 
-    def _srcMediaData(self, fname):
+    def _extract(self, name, path):
+        "Copy zip member NAME to PATH a chunk at a time."
+        src = self.zip.open(name)
+        out = open(path, "wb")
+        try:
+            shutil.copyfileobj(src, out, CHUNK_SIZE)
+        finally:
+            out.close()
+            src.close()
+
+    def _srcMediaFile(self, fname):
         if fname in self.nameToNum:
-            return self.zip.read(self.nameToNum[fname])
+            name = self.nameToNum[fname]
+            if self.zip.getinfo(name).file_size:
+                return self.zip.open(name)
         return None
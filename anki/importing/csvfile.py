@@ -4,7 +4,7 @@
 
 import codecs
 import csv
-import re
+import itertools
 
 from anki.importing.noteimp import NoteImporter, ForeignNote
 from anki.lang import _
@@ -18,21 +18,36 @@ class TextImporter(NoteImporter):
     def __init__(self, *args):
         NoteImporter.__init__(self, *args)
         self.lines = None
-        self.fileobj = None
+        self.data = None
         self.delimiter = None
         self.tagsToAdd = []
+        self._tagsLine = False
+
+    def run(self):
+        "Import, reading the file a batch of notes at a time."
+        assert self.mapping
+        # read through the file first, so a bad line near the end doesn't
+        # leave a partial import behind
+        for note in self.iterNotes():
+            pass
+        self.importBatches(self.iterNotes())
 
     def foreignNotes(self):
+        return list(self.iterNotes())
+
+    def iterNotes(self):
+        "Yield a note for each line of the file, as the file is read."
         self.open()
         # process all lines
-        log = []
-        notes = []
-        lineNum = 0
-        ignored = 0
+        self.log = log = []
+        self.ignored = 0
+        lines = self._lines()
+        if self._tagsLine:
+            lines.next()
         if self.delimiter:
-            reader = csv.reader(self.data, delimiter=self.delimiter, doublequote=True)
+            reader = csv.reader(lines, delimiter=self.delimiter, doublequote=True)
         else:
-            reader = csv.reader(self.data, self.dialect, doublequote=True)
+            reader = csv.reader(lines, self.dialect, doublequote=True)
         try:
             for row in reader:
                 row = [unicode(x, "utf-8") for x in row]
@@ -45,16 +60,13 @@ class TextImporter(NoteImporter):
                             "num1": len(row),
                             "num2": self.numFields,
                             })
-                        ignored += 1
+                        self.ignored += 1
                     continue
-                note = self.noteFromFields(row)
-                notes.append(note)
+                yield self.noteFromFields(row)
         except (csv.Error), e:
             log.append(_("Aborted: %s") % str(e))
-        self.log = log
-        self.ignored = ignored
-        self.fileobj.close()
-        return notes
+        finally:
+            lines.close()
 
     def open(self):
         "Parse the top line and determine the pattern and number of fields."
@@ -62,28 +74,44 @@ class TextImporter(NoteImporter):
         self.cacheFile()
 
     def cacheFile(self):
-        "Read file into self.lines if not already there."
-        if not self.fileobj:
+        "Read the start of the file into self.data if not already there."
+        if self.data is None:
             self.openFile()
 
     def openFile(self):
         self.dialect = None
-        self.fileobj = open(self.file, "rbU")
-        self.data = self.fileobj.read()
-        if self.data.startswith(codecs.BOM_UTF8):
-            self.data = self.data[len(codecs.BOM_UTF8):]
-        def sub(s):
-            return re.sub("^\#.*$", "__comment", s)
-        self.data = [sub(x)+"\n" for x in self.data.split("\n") if sub(x) != "__comment"]
+        # the format is worked out from the first lines
+        lines = self._lines()
+        self.data = list(itertools.islice(lines, 11))
+        lines.close()
         if self.data:
             if self.data[0].startswith("tags:"):
                 tags = unicode(self.data[0][5:], "utf8").strip()
                 self.tagsToAdd = tags.split(" ")
+                self._tagsLine = True
                 del self.data[0]
             self.updateDelimiter()
         if not self.dialect and not self.delimiter:
             raise Exception("unknownFormat")
 
+    def _lines(self):
+        "Yield the lines of the file, skipping comments."
+        f = open(self.file, "rbU")
+        try:
+            first = True
+            for line in f:
+                if first:
+                    if line.startswith(codecs.BOM_UTF8):
+                        line = line[len(codecs.BOM_UTF8):]
+                    first = False
+                if line.startswith("#"):
+                    continue
+                if not line.endswith("\n"):
+                    line += "\n"
+                yield line
+        finally:
+            f.close()
+
     def updateDelimiter(self):
         def err():
             raise Exception("unknownFormat")
@@ -6,9 +6,10 @@ import  cgi
 from anki.consts import NEW_CARDS_RANDOM
 from anki.lang import _
 from anki.utils import fieldChecksum, guid64, timestampID, \
-    joinFields, intTime, splitFields
+    joinFields, intTime, splitFields, ids2str
 from anki.importing.base import Importer
 from anki.lang import ngettext
+from anki.hooks import runHook
 
 # Stores a list of fields, tags and deck
 ######################################################################
@@ -49,6 +50,8 @@ class NoteImporter(Importer):
     needDelimiter = False
     allowHTML = False
     importMode = 0
+    # notes imported at a time by importBatches()
+    batchSize = 1000
 
     def __init__(self, col, file):
         Importer.__init__(self, col, file)
@@ -90,42 +93,72 @@ class NoteImporter(Importer):
 
     def importNotes(self, notes):
         "Convert each card into a note, apply attributes and add to col."
+        self._startImport()
+        self._importBatch(notes)
+        self._finishImport()
+
+    def importBatches(self, notes):
+        """Like importNotes(), but NOTES may be an iterator, which is imported
+batchSize notes at a time. The 'importProgress' hook is called with the number
+of notes processed after each batch."""
+        self._startImport()
+        batch = []
+        for note in notes:
+            batch.append(note)
+            if len(batch) >= self.batchSize:
+                self._importBatch(batch)
+                batch = []
+        if batch:
+            self._importBatch(batch)
+        self._finishImport()
+
+    def _startImport(self):
         assert self.mappingOk()
         # note whether tags are mapped
         self._tagsMapped = False
         for f in self.mapping:
             if f == "_tags":
                 self._tagsMapped = True
-        # gather checks for duplicate comparison
-        csums = {}
-        for csum, id in self.col.db.execute(
-            "select csum, id from notes where mid = ?", self.model['id']):
-            if csum in csums:
-                csums[csum].append(id)
-            else:
-                csums[csum] = [id]
-        firsts = {}
-        fld0idx = self.mapping.index(self.model['flds'][0]['name'])
+        self._fld0idx = self.mapping.index(self.model['flds'][0]['name'])
         self._fmap = self.col.models.fieldMap(self.model)
         self._nextID = timestampID(self.col.db, "notes")
+        # first fields seen so far, and duplicates added in mode 2
+        self._firsts = set()
+        self._dupes = set()
+        # notes added by earlier batches aren't duplicates of the collection
+        self._newIds = set()
+        self._updateLog = []
+        self._emptyNotes = False
+        self._emptyCards = False
+        self._processed = 0
+        self._added = 0
+        self._updated = 0
+        self._dupeCount = 0
+        self.total = 0
+
+    def _importBatch(self, notes):
+        fld0idx = self._fld0idx
+        for n in notes:
+            for c in range(len(n.fields)):
+                if not self.allowHTML:
+                    n.fields[c] = cgi.escape(n.fields[c])
+                n.fields[c] = n.fields[c].strip().replace("\n", "<br>")
+        # fetch the existing notes that could be duplicates up front
+        nsums = [fieldChecksum(n.fields[fld0idx]) for n in notes]
+        csums = self._notesByChecksum(nsums)
+        firsts = self._firsts
+        dupes = self._dupes
+        updateLog = self._updateLog
         # loop through the notes
         updates = []
-        updateLog = []
         updateLogTxt = _("First field matched: %s")
         dupeLogTxt = _("Added duplicate with first field: %s")
         new = []
         self._ids = []
         self._cards = []
-        self._emptyNotes = False
         dupeCount = 0
-        dupes = []
-        for n in notes:
-            for c in range(len(n.fields)):
-                if not self.allowHTML:
-                    n.fields[c] = cgi.escape(n.fields[c])
-                n.fields[c] = n.fields[c].strip().replace("\n", "<br>")
+        for n, csum in zip(notes, nsums):
             fld0 = n.fields[fld0idx]
-            csum = fieldChecksum(fld0)
             # first field must exist
             if not fld0:
                 self.log.append(_("Empty first field: %s") %
@@ -137,20 +170,19 @@ class NoteImporter(Importer):
                 self.log.append(_("Appeared twice in file: %s") %
                                 fld0)
                 continue
-            firsts[fld0] = True
+            firsts.add(fld0)
             # already exists?
             found = False
             if csum in csums:
                 # csum is not a guarantee; have to check
-                for id in csums[csum]:
-                    flds = self.col.db.scalar(
-                        "select flds from notes where id = ?", id)
-                    sflds = splitFields(flds)
+                for id, sflds in csums[csum]:
+                    if id in self._newIds:
+                        continue
                     if fld0 == sflds[0]:
                         # duplicate
                         found = True
                         if self.importMode == 0:
-                            data = self.updateData(n, id, sflds)
+                            data = self.updateData(n, id, list(sflds))
                             if data:
                                 updates.append(data)
                                 updateLog.append(updateLogTxt % fld0)
@@ -164,7 +196,7 @@ class NoteImporter(Importer):
                                 # only show message once, no matter how many
                                 # duplicates are in the collection already
                                 updateLog.append(dupeLogTxt % fld0)
-                                dupes.append(fld0)
+                                dupes.add(fld0)
                             found = False
             # newly add
             if not found:
@@ -172,17 +204,29 @@ class NoteImporter(Importer):
                 if data:
                     new.append(data)
                     # note that we've seen this note once already
-                    firsts[fld0] = True
+                    firsts.add(fld0)
         self.addNew(new)
+        self._newIds.update(r[0] for r in new)
         self.addUpdates(updates)
         # make sure to update sflds, etc
         self.col.updateFieldCache(self._ids)
         # generate cards
         if self.col.genCards(self._ids):
-            self.log.insert(0, _(
-                "Empty cards found. Please run Tools>Empty Cards."))
+            self._emptyCards = True
         # apply scheduling updates
         self.updateCards()
+        self._processed += len(notes)
+        self._added += len(new)
+        self._updated += self.updateCount
+        self._dupeCount += dupeCount
+        self.total += len(self._ids)
+        runHook("importProgress", self._processed)
+
+    def _finishImport(self):
+        self.updateCount = self._updated
+        if self._emptyCards:
+            self.log.insert(0, _(
+                "Empty cards found. Please run Tools>Empty Cards."))
         # we randomize or order here, to ensure that siblings
         # have the same due#
         did = self.col.decks.selected()
@@ -193,7 +237,9 @@ class NoteImporter(Importer):
         else:
             self.col.sched.orderCards(did)
 
-        part1 = ngettext("%d note added", "%d notes added", len(new)) % len(new)
+        added = self._added
+        dupeCount = self._dupeCount
+        part1 = ngettext("%d note added", "%d notes added", added) % added
         part2 = ngettext("%d note updated", "%d notes updated",
                          self.updateCount) % self.updateCount
         if self.importMode == 0:
@@ -205,13 +251,23 @@ class NoteImporter(Importer):
         part3 = ngettext("%d note unchanged", "%d notes unchanged",
                          unchanged) % unchanged
         self.log.append("%s, %s, %s." % (part1, part2, part3))
-        self.log.extend(updateLog)
+        self.log.extend(self._updateLog)
         if self._emptyNotes:
             self.log.append(_("""\
 One or more notes were not imported, because they didn't generate any cards. \
 This can happen when you have empty fields or when you have not mapped the \
 content in the text file to the correct fields."""))
-        self.total = len(self._ids)
+
+    def _notesByChecksum(self, csums):
+        "Return {csum: [(id, fields)]} for notes of the model with CSUMS."
+        found = {}
+        csums = list(set(csums))
+        for i in range(0, len(csums), 500):
+            for csum, id, flds in self.col.db.execute("""
+select csum, id, flds from notes where mid = ? and csum in %s
+order by id""" % ids2str(csums[i:i+500]), self.model['id']):
+                found.setdefault(csum, []).append((id, splitFields(flds)))
+        return found
 
     def newData(self, n):
         id = self._nextID
@@ -9,7 +9,10 @@ from anki.importing.noteimp import NoteImporter, ForeignNote, ForeignCard
 from anki.lang import _
 from anki.lang import ngettext
 
-from xml.dom import minidom
+try:
+    from xml.etree import cElementTree as ElementTree
+except ImportError:
+    from xml.etree import ElementTree
 from types import DictType, InstanceType
 from string import capwords
 import re, unicodedata, time
@@ -92,7 +95,6 @@ class SupermemoXmlImporter(NoteImporter):
         self.numFields=int(2)
 
         # SmXmlParse VARIABLES
-        self.xmldoc = None
         self.pieces = []
         self.cntBuf = [] #to store last parsed data
         self.cntElm = [] #to store SM Elements data
@@ -166,21 +168,35 @@ class SupermemoXmlImporter(NoteImporter):
 
 ## DEFAULT IMPORTER METHODS
 
+    def run(self):
+        "Import, parsing the file a batch of notes at a time."
+        assert self.mapping
+        # parse the file first, so a malformed element near the end doesn't
+        # leave a partial import behind
+        for item in self.parse(self.file):
+            pass
+        self.importBatches(self.iterNotes())
+
     def foreignNotes(self):
+        return list(self.iterNotes())
 
-        # Load file and parse it by minidom
-        self.loadSource(self.file)
+    def iterNotes(self):
+        "Yield notes as their elements are parsed from the file."
 
         # Migrating content / time consuming part
         # addItemToCards is called for each sm element
         self.logger(u'Parsing started.')
-        self.parse()
+        total = 0
+        for item in self.parse(self.file):
+            self.notes = []
+            self.addItemToCards(item)
+            for note in self.notes:
+                yield note
+            total += len(self.notes)
+        self.notes = []
         self.logger(u'Parsing done.')
 
-        # Return imported cards
-        self.total = len(self.notes)
-        self.log.append(ngettext("%d card imported.", "%d cards imported.", self.total) % self.total)
-        return self.notes
+        self.log.append(ngettext("%d card imported.", "%d cards imported.", total) % total)
 
     def fields(self):
         return 2
@@ -282,75 +298,62 @@ class SupermemoXmlImporter(NoteImporter):
         import StringIO
         return StringIO.StringIO(str(source))
 
-    def loadSource(self, source):
-        """Load source file and parse with xml.dom.minidom"""
-        self.source = source
-        self.logger(u'Load started...')
-        sock = open(self.source)
-        self.xmldoc = minidom.parse(sock).documentElement
-        sock.close()
-        self.logger(u'Load done.')
-
 
     # PARSE
-    def parse(self, node=None):
-        "Parse method - parses document elements"
-
-        if node==None and self.xmldoc<>None:
-          node = self.xmldoc
-
-        _method = "parse_%s" % node.__class__.__name__
-        if hasattr(self,_method):
-          parseMethod = getattr(self, _method)
-          parseMethod(node)
-        else:
-          self.logger(u'No handler for method %s' % _method, level=3)
-
-    def parse_Document(self, node):
-        "Parse XML document"
-
-        self.parse(node.documentElement)
+    def parse(self, source):
+        """Parse source file incrementally, yielding each SM element that
+should be imported as soon as it is complete"""
 
-    def parse_Element(self, node):
-        "Parse XML element"
-
-        _method = "do_%s" % node.tagName
-        if hasattr(self,_method):
-          handlerMethod = getattr(self, _method)
-          handlerMethod(node)
-        else:
-          self.logger(u'No handler for method %s' % _method, level=3)
-          #print traceback.print_exc()
-
-    def parse_Text(self, node):
-        "Parse text inside elements. Text is stored into local buffer."
+        self.logger(u'Load started...')
+        sock = open(source, "rb")
+        try:
+            # elements being parsed, outermost first
+            stack = []
+            for event, node in ElementTree.iterparse(sock, ("start", "end")):
+                if event == "start":
+                    if node.tag == "SuperMemoElement":
+                        self.startElement()
+                    stack.append(node)
+                    continue
+                stack.pop()
+                if node.tag == "SuperMemoElement":
+                    smel = self.endElement()
+                    if smel:
+                        yield smel
+                    # done with it; drop it so memory use stays flat
+                    if stack:
+                        stack[-1].remove(node)
+                elif stack and stack[-1].tag == "SuperMemoElement":
+                    _method = "do_%s" % node.tag
+                    if hasattr(self,_method):
+                      handlerMethod = getattr(self, _method)
+                      handlerMethod(node)
+                    else:
+                      self.logger(u'No handler for method %s' % _method, level=3)
+        finally:
+            sock.close()
+        self.logger(u'Load done.')
 
-        text = node.data
-        self.cntBuf.append(text)
+    def _text(self, node):
+        "Text of node as unicode, or None if it has none"
 
-    #def parse_Comment(self, node):
-    #    """
-    #    Source can contain XML comments, but we ignore them
-    #    """
-    #    pass
+        if node.text is None:
+          return None
+        return unicode(node.text)
 
 
     # DO
-    def do_SuperMemoCollection(self, node):
-        "Process SM Collection"
-
-        for child in node.childNodes: self.parse(child)
-
-    def do_SuperMemoElement(self, node):
-        "Process SM Element (Type - Title,Topics)"
+    def startElement(self):
+        "Process start of SM Element (Type - Title,Topics)"
 
         self.logger('='*45, level=3)
 
         self.cntElm.append(SuperMemoElement())
         self.cntElm[-1]['lTitle'] = self.cntMeta['title']
 
-        #parse all child elements
-        for child in node.childNodes: self.parse(child)
+    def endElement(self):
+        """Process end of SM Element. Returns the element if it's an item to
+be imported."""
 
         #strip all saved strings, just for sure
         for key in self.cntElm[-1].keys():
@@ -370,13 +373,13 @@ class SupermemoXmlImporter(NoteImporter):
               self.logger(u'Element skiped  \t- not memorized ...', level=3)
             else:
               #import sm element data to Anki
-              self.addItemToCards(smel)
               self.logger(u"Import element \t- " + smel['Question'], level=3)
 
               #print element
               self.logger('-'*45, level=3)
               for key in smel.keys():
                 self.logger('\t%s %s' % ((key+':').ljust(15),smel[key]), level=3 )
+              return smel
           else:
             self.logger(u'Element skiped  \t- no valid Q and A ...', level=3)
 
@@ -394,32 +397,22 @@ class SupermemoXmlImporter(NoteImporter):
     def do_Content(self, node):
         "Process SM element Content"
 
-        for child in node.childNodes:
-          if hasattr(child,'tagName') and child.firstChild != None:
-            self.cntElm[-1][child.tagName]=child.firstChild.data
+        for child in node:
+          if self._text(child) != None:
+            self.cntElm[-1][child.tag]=self._text(child)
 
     def do_LearningData(self, node):
         "Process SM element LearningData"
 
-        for child in node.childNodes:
-          if hasattr(child,'tagName') and child.firstChild != None:
-            self.cntElm[-1][child.tagName]=child.firstChild.data
-
-    # It's being processed in do_Content now
-    #def do_Question(self, node):
-    #    for child in node.childNodes: self.parse(child)
-    #    self.cntElm[-1][node.tagName]=self.cntBuf.pop()
-
-    # It's being processed in do_Content now
-    #def do_Answer(self, node):
-    #    for child in node.childNodes: self.parse(child)
-    #    self.cntElm[-1][node.tagName]=self.cntBuf.pop()
+        for child in node:
+          if self._text(child) != None:
+            self.cntElm[-1][child.tag]=self._text(child)
 
     def do_Title(self, node):
         "Process SM element Title"
 
-        t = self._decode_htmlescapes(node.firstChild.data)
-        self.cntElm[-1][node.tagName] = t
+        t = self._decode_htmlescapes(self._text(node))
+        self.cntElm[-1][node.tag] = t
         self.cntMeta['title'].append(t)
         self.cntElm[-1]['lTitle'] = self.cntMeta['title']
         self.logger(u'Start of topic \t- ' + u" / ".join(self.cntMeta['title']), level=2)
@@ -428,8 +421,8 @@ class SupermemoXmlImporter(NoteImporter):
     def do_Type(self, node):
         "Process SM element Type"
 
-        if len(self.cntBuf) >=1 :
-          self.cntElm[-1][node.tagName]=self.cntBuf.pop()
+        if self._text(node) != None:
+          self.cntElm[-1][node.tag]=self._text(node)
 
 
 if __name__ == '__main__':
@@ -7,10 +7,13 @@ import traceback
 import urllib
 import unicodedata
 import sys
+import stat
 import zipfile
+import shutil
 from cStringIO import StringIO
+from multiprocessing.pool import ThreadPool
 
-from anki.utils import checksum, isWin, isMac, json
+from anki.utils import checksum, checksumFile, isWin, isMac, json, ids2str
 from anki.db import DB
 from anki.consts import *
 from anki.latex import mungeQA
@@ -26,8 +29,12 @@ class MediaManager(object):
     ]
     regexps = soundRegexps + imgRegexps
 
+    # threads used to checksum files when scanning for changes
+    scanThreads = 4
+
     def __init__(self, col, server):
         self.col = col
+        self._refs = None
         if server:
             self._dir = None
             return
@@ -60,6 +67,7 @@ class MediaManager(object):
         if create:
             self._initDB()
         self.maybeUpgrade()
+        self._initStats()
 
     def _initDB(self):
         self.db.executescript("""
@@ -75,6 +83,17 @@ create index idx_media_dirty on media (dirty);
 create table meta (dirMod int, lastUsn int); insert into meta values (0, 0);
 """)
 
+    def _initStats(self):
+        # the stat() details of each file when it was last scanned, so an
+        # unchanged file doesn't need to be read
+        self.db.execute("""
+create table if not exists stats (
+ fname text not null primary key,
+ ino int not null,
+ size int not null,
+ mtime int not null
+)""")
+
     def maybeUpgrade(self):
         oldpath = self.dir()+".db"
         if os.path.exists(oldpath):
@@ -135,9 +154,17 @@ create table meta (dirMod int, lastUsn int); insert into meta values (0, 0);
     # opath must be in unicode
 
     def addFile(self, opath):
-        return self.writeData(opath, open(opath, "rb").read())
+        def write(path):
+            shutil.copyfile(opath, path)
+        return self._addMedia(opath, checksumFile(opath), write)
 
     def writeData(self, opath, data):
+        def write(path):
+            open(path, "wb").write(data)
+        return self._addMedia(opath, checksum(data), write)
+
+    def _addMedia(self, opath, csum, write):
+        "Call WRITE with the path to store a file with checksum CSUM in."
         # if fname is a full path, use only the basename
         fname = os.path.basename(opath)
         # make sure we write it in NFC form (on mac will autoconvert to NFD),
@@ -150,16 +177,15 @@ create table meta (dirMod int, lastUsn int); insert into meta values (0, 0);
             n = int(match.group(1))
             return " (%d)" % (n+1)
         # find the first available name
-        csum = checksum(data)
         while True:
             fname = root + ext
             path = os.path.join(self.dir(), fname)
             # if it doesn't exist, copy it directly
             if not os.path.exists(path):
-                open(path, "wb").write(data)
+                write(path)
                 return fname
             # if it's identical, reuse
-            if checksum(open(path, "rb").read()) == csum:
+            if checksumFile(path) == csum:
                 return fname
             # otherwise, increment the index in the filename
             reg = " \((\d+)\)$"
@@ -171,11 +197,15 @@ create table meta (dirMod int, lastUsn int); insert into meta values (0, 0);
     # String manipulation
     ##########################################################################
 
-    def filesInStr(self, mid, string, includeRemote=False):
+    def filesInStr(self, mid, string, includeRemote=False, latex=True):
+        """Files referred to by STRING. If LATEX is true, LaTeX in it is
+converted to images first, building any that are missing."""
         l = []
         model = self.col.models.get(mid)
         strings = []
-        if model['type'] == MODEL_CLOZE and "{{c" in string:
+        if not latex:
+            strings = [string]
+        elif model['type'] == MODEL_CLOZE and "{{c" in string:
             # if the field has clozes in it, we'll need to expand the
             # possibilities so we can render latex
             strings = self._expandClozes(string)
@@ -183,7 +213,8 @@ create table meta (dirMod int, lastUsn int); insert into meta values (0, 0);
             strings = [string]
         for string in strings:
             # handle latex
-            string = mungeQA(string, None, None, model, None, self.col)
+            if latex:
+                string = mungeQA(string, None, None, model, None, self.col)
             # extract filenames
             for reg in self.regexps:
                 for match in re.finditer(reg, string):
@@ -237,6 +268,95 @@ create table meta (dirMod int, lastUsn int); insert into meta values (0, 0);
             string = re.sub(reg, repl, string)
         return string
 
+    # Note references
+    ##########################################################################
+    # The local files each note refers to are kept in the collection, so
+    # checking and exporting media don't need to scan every note. The table
+    # is created the first time media is checked. Images for LaTeX aren't
+    # stored, as finding them means rendering the LaTeX; they're looked up
+    # from the notes containing it when needed.
+
+    def haveRefs(self):
+        if self._refs is None:
+            self._refs = bool(self.col.db.scalar(
+                "select 1 from sqlite_master where name = 'mediarefs'"))
+        return self._refs
+
+    def rebuildRefs(self):
+        "Create or refill the reference table from all notes."
+        if not self.haveRefs():
+            self.col.db.execute("""
+create table if not exists mediarefs (
+ nid integer not null,
+ fname text not null,
+ primary key (nid, fname)
+)""")
+            self._refs = True
+        self.col.db.execute("delete from mediarefs")
+        self._addRefs(self.col.db.execute("select id, mid, flds from notes"))
+
+    def updateRefs(self, nids):
+        "Update references after notes have been modified or deleted."
+        if not self.haveRefs():
+            return
+        snids = ids2str(nids)
+        self.col.db.execute("delete from mediarefs where nid in "+snids)
+        self._addRefs(self.col.db.execute(
+            "select id, mid, flds from notes where id in "+snids))
+
+    def _addRefs(self, rows):
+        data = []
+        for nid, mid, flds in rows:
+            if not self.col.models.get(mid):
+                # note points to invalid model
+                continue
+            for fname in set(self.filesInStr(mid, flds, latex=False)):
+                data.append((nid, fname))
+        self.col.db.executemany(
+            "insert into mediarefs values (?,?)", data)
+
+    def filesInNotes(self, nids):
+        "Files referred to by NIDS."
+        snids = ids2str(nids)
+        if self.haveRefs():
+            files = set(self.col.db.list(
+                "select distinct fname from mediarefs where nid in "+snids))
+            files.update(self._latexRefs("and id in "+snids))
+            return list(files)
+        files = set()
+        for mid, flds in self.col.db.execute(
+            "select mid, flds from notes where id in "+snids):
+            files.update(self.filesInStr(mid, flds))
+        return list(files)
+
+    def _allRefs(self):
+        "All files referred to by notes, fixing any not in NFC form."
+        if not self.haveRefs():
+            self.rebuildRefs()
+        refs = set(self.col.db.list("select distinct fname from mediarefs"))
+        nids = set()
+        for f in refs:
+            if f != unicodedata.normalize("NFC", f):
+                nids.update(self.col.db.list(
+                    "select nid from mediarefs where fname = ?", f))
+        if nids:
+            for nid in nids:
+                self._normalizeNoteRefs(nid)
+            refs = set(self.col.db.list(
+                "select distinct fname from mediarefs"))
+        refs.update(self._latexRefs())
+        return refs
+
+    def _latexRefs(self, lim=""):
+        "Images for the LaTeX in notes matching LIM, building missing ones."
+        files = set()
+        for mid, flds in self.col.db.execute("""
+select mid, flds from notes where (flds like '%[latex]%' or
+flds like '%[$]%' or flds like '%[$$]%') """+lim):
+            if self.col.models.get(mid):
+                files.update(self.filesInStr(mid, flds))
+        return files
+
     # Rebuilding DB
     ##########################################################################
 
@@ -244,17 +364,7 @@ create table meta (dirMod int, lastUsn int); insert into meta values (0, 0);
         "Return (missingFiles, unusedFiles)."
         mdir = self.dir()
         # gather all media references in NFC form
-        allRefs = set()
-        for nid, mid, flds in self.col.db.execute("select id, mid, flds from notes"):
-            noteRefs = self.filesInStr(mid, flds)
-            # check the refs are in NFC
-            for f in noteRefs:
-                # if they're not, we'll need to fix them first
-                if f != unicodedata.normalize("NFC", f):
-                    self._normalizeNoteRefs(nid)
-                    noteRefs = self.filesInStr(mid, flds)
-                    break
-            allRefs.update(noteRefs)
+        allRefs = self._allRefs()
         # loop through media folder
         unused = []
         invalid = []
@@ -342,7 +452,20 @@ create table meta (dirMod int, lastUsn int); insert into meta values (0, 0);
         return int(os.stat(path).st_mtime)
 
     def _checksum(self, path):
-        return checksum(open(path, "rb").read())
+        return checksumFile(path)
+
+    def _checksums(self, paths):
+        "Checksum PATHS, using several threads if there are many."
+        if len(paths) < 2 or self.scanThreads < 2:
+            return [self._checksum(p) for p in paths]
+        # hashlib releases the GIL on large buffers, so reading and hashing
+        # overlaps between threads
+        pool = ThreadPool(self.scanThreads)
+        try:
+            return pool.map(self._checksum, paths)
+        finally:
+            pool.close()
+            pool.join()
 
     def _changed(self):
         "Return dir mtime if it has changed since the last findChanges()"
@@ -355,15 +478,28 @@ create table meta (dirMod int, lastUsn int); insert into meta values (0, 0);
 
     def _logChanges(self):
         (added, removed) = self._changes()
+        # files modified since the last scan have already been checksummed
+        new = [f for f in added if f not in self._csums]
+        for f, csum in zip(new, self._checksums(new)):
+            self._csums[f] = csum
         media = []
         for f in added:
-            mt = self._mtime(f)
-            media.append((f, self._checksum(f), mt, 1))
+            if f in self._scanned:
+                mt = self._scanned[f][2]
+            else:
+                mt = self._mtime(f)
+            media.append((f, self._csums[f], mt, 1))
         for f in removed:
             media.append((f, None, 0, 1))
         # update media db
         self.db.executemany("insert or replace into media values (?,?,?,?)",
                             media)
+        self.db.executemany("insert or replace into stats values (?,?,?,?)",
+                            [(f,)+s for f, s in self._scanned.items()
+                             if self._stats.get(f) != s])
+        self.db.executemany("delete from stats where fname = ?",
+                            [(f,) for f in self._stats
+                             if f not in self._scanned])
         self.db.execute("update meta set dirMod = ?", self._mtime(self.dir()))
         self.db.commit()
 
@@ -372,12 +508,25 @@ create table meta (dirMod int, lastUsn int); insert into meta values (0, 0);
         for (name, csum, mod) in self.db.execute(
             "select fname, csum, mtime from media where csum is not null"):
             self.cache[name] = [csum, mod, False]
-        added = []
+        # (inode, size, mtime) from the last scan, and from this one
+        self._stats = {}
+        for (name, ino, size, mod) in self.db.execute(
+            "select fname, ino, size, mtime from stats"):
+            self._stats[name] = (ino, size, mod)
+        self._scanned = {}
+        self._csums = {}
+        found = []
+        check = []
         removed = []
-        # loop through on-disk files
+        # loop through on-disk files, with a single stat() for each
         for f in os.listdir(self.dir()):
+            try:
+                st = os.stat(f)
+            except OSError:
+                # removed during the scan
+                continue
             # ignore folders and thumbs.db
-            if os.path.isdir(f):
+            if stat.S_ISDIR(st.st_mode):
                 continue
             if f.lower() == "thumbs.db":
                 continue
@@ -385,7 +534,7 @@ create table meta (dirMod int, lastUsn int); insert into meta values (0, 0);
             if self.hasIllegal(f):
                 continue
             # empty files are invalid; clean them up and continue
-            sz = os.path.getsize(f)
+            sz = st.st_size
             if not sz:
                 os.unlink(f)
                 continue
@@ -401,17 +550,29 @@ create table meta (dirMod int, lastUsn int); insert into meta values (0, 0);
                         os.unlink(f)
                     else:
                         os.rename(f, normf)
+            info = (st.st_ino, sz, int(st.st_mtime))
+            self._scanned[f] = info
             # newly added?
             if f not in self.cache:
-                added.append(f)
+                found.append(f)
             else:
-                # modified since last time?
-                if self._mtime(f) != self.cache[f][1]:
-                    # and has different checksum?
-                    if self._checksum(f) != self.cache[f][0]:
-                        added.append(f)
+                # modified since last time? files from before stats were
+                # recorded only have their mtime compared
+                if f in self._stats:
+                    modified = self._stats[f] != info
+                else:
+                    modified = info[2] != self.cache[f][1]
+                if modified:
+                    found.append(f)
+                    check.append(f)
                 # mark as used
                 self.cache[f][2] = True
+        # checksum the possibly modified files, and keep the ones that
+        # actually changed
+        for f, csum in zip(check, self._checksums(check)):
+            self._csums[f] = csum
+        added = [f for f in found if f not in self._csums or
+                 self._csums[f] != self.cache[f][0]]
         # look for any entries in the cache that no longer exist on disk
         for (k, v) in self.cache.items():
             if not v[2]:
@@ -433,10 +594,22 @@ create table meta (dirMod int, lastUsn int); insert into meta values (0, 0);
             "select csum, dirty from media where fname=?", fname)
         return ret or (None, 0)
 
+    def syncInfos(self, fnames):
+        "Return {fname: (csum, dirty)} for the FNAMES in the DB."
+        ret = {}
+        # stay under sqlite's limit on bound variables
+        for i in range(0, len(fnames), 500):
+            chunk = fnames[i:i+500]
+            for fname, csum, dirty in self.db.execute(
+                "select fname, csum, dirty from media where fname in (%s)"
+                % ",".join("?"*len(chunk)), *chunk):
+                ret[fname] = (csum, dirty)
+        return ret
+
     def markClean(self, fnames):
-        for fname in fnames:
-            self.db.execute(
-                "update media set dirty=0 where fname=?", fname)
+        self.db.executemany(
+            "update media set dirty=0 where fname=?",
+            [(fname,) for fname in fnames])
 
     def syncDelete(self, fname):
         if os.path.exists(fname):
@@ -453,6 +626,7 @@ create table meta (dirMod int, lastUsn int); insert into meta values (0, 0);
 
     def forceResync(self):
         self.db.execute("delete from media")
+        self.db.execute("delete from stats")
         self.db.execute("update meta set lastUsn=0,dirMod=0")
         self.db.execute("vacuum analyze")
         self.db.commit()
@@ -461,6 +635,24 @@ create table meta (dirMod int, lastUsn int); insert into meta values (0, 0);
     ##########################################################################
 
     def mediaChangesZip(self):
+        return self._changesZip(self.db.all(
+            "select fname, csum from media where dirty=1"
+            " limit %d"%SYNC_ZIP_COUNT))
+
+    def dirtyMedia(self):
+        "(fname, csum) for each change that needs to be sent."
+        return self.db.all("select fname, csum from media where dirty=1")
+
+    def mediaZips(self, rows):
+        """Yield (zip, fnames) for the changes in ROWS from dirtyMedia().
+Doesn't touch the DB, so it can be run in another thread."""
+        while rows:
+            zip, fnames = self._changesZip(rows)
+            rows = rows[len(fnames):]
+            yield zip, fnames
+
+    def _changesZip(self, rows):
+        "Zip up changes from the start of ROWS, returning (zip, fnames)."
         f = StringIO()
         z = zipfile.ZipFile(f, "w", compression=zipfile.ZIP_DEFLATED)
 
@@ -470,18 +662,17 @@ create table meta (dirMod int, lastUsn int); insert into meta values (0, 0);
         meta = []
         sz = 0
 
-        for c, (fname, csum) in enumerate(self.db.execute(
-                        "select fname, csum from media where dirty=1"
-                        " limit %d"%SYNC_ZIP_COUNT)):
+        for c, (fname, csum) in enumerate(rows[:SYNC_ZIP_COUNT]):
 
             fnames.append(fname)
             normname = unicodedata.normalize("NFC", fname)
+            path = os.path.join(self.dir(), fname)
 
             if csum:
                 self.col.log("+media zip", fname)
-                z.write(fname, str(c))
+                z.write(path, str(c))
                 meta.append((normname, str(c)))
-                sz += os.path.getsize(fname)
+                sz += os.path.getsize(path)
             else:
                 self.col.log("-media zip", fname)
                 meta.append((normname, ""))
@@ -507,8 +698,6 @@ create table meta (dirMod int, lastUsn int); insert into meta values (0, 0);
                 # ignore previously-retrieved meta
                 continue
             else:
-                data = z.read(i)
-                csum = checksum(data)
                 name = meta[i.filename]
                 if not isinstance(name, unicode):
                     name = unicode(name, "utf8")
@@ -517,8 +706,16 @@ create table meta (dirMod int, lastUsn int); insert into meta values (0, 0);
                     name = unicodedata.normalize("NFD", name)
                 else:
                     name = unicodedata.normalize("NFC", name)
-                # save file
-                open(name, "wb").write(data)
+                # save file, checksumming it as it's extracted
+                src = z.open(i)
+                try:
+                    out = open(name, "wb")
+                    try:
+                        csum = checksumFile(src, out)
+                    finally:
+                        out.close()
+                finally:
+                    src.close()
                 # update db
                 media.append((name, csum, self._mtime(name), 0))
                 cnt += 1
@@ -8,6 +8,10 @@ from anki.utils import intTime, joinFields, splitFields, ids2str,\
 from anki.lang import _
 from anki.consts import *
 from anki.hooks import runHook
+import anki.hooks
+import anki.latex
+import anki.template
+from anki.template import furigana, hint
 import time
 
 # Models
@@ -69,6 +73,14 @@ defaultTemplate = {
     #'bsize': 12,
 }
 
+# req results from _reqFromTemplate(), keyed on the template text and the
+# values it may refer to
+_reqCache = {}
+
+# fmod_ filters known not to change whether a field's content is shown
+_reqSafeFilters = (hint.hint, furigana.kanji, furigana.kana,
+                 furigana.furigana)
+
 class ModelManager(object):
 
     # Saving/loading registry
@@ -335,6 +347,9 @@ and notes.mid = ? and cards.ord = ?""", m['id'], ord)
                       intTime(), self.col.usn(), id))
         self.col.db.executemany(
             "update notes set flds=?,mod=?,usn=? where id = ?", r)
+        nids = [x[3] for x in r]
+        self.col.updateSearchIndex(nids)
+        self.col.media.updateRefs(nids)
 
     # Templates
     ##################################################
@@ -490,7 +505,9 @@ select id from notes where mid = ?)""" % " ".join(map),
         req = []
         flds = [f['name'] for f in m['flds']]
         for t in m['tmpls']:
-            ret = self._reqForTemplate(m, flds, t)
+            ret = self._reqFromTemplate(m, flds, t)
+            if ret is None:
+                ret = self._reqForTemplate(m, flds, t)
             req.append((t['ord'], ret[0], ret[1]))
         m['req'] = req
 
@@ -531,37 +548,91 @@ select id from notes where mid = ?)""" % " ".join(map),
                 req.append(i)
         return type, req
 
+    def _reqFromTemplate(self, m, flds, t):
+        """Like _reqForTemplate(), but renders the compiled template directly
+instead of going through _renderQA(), and caches the result on the template
+text. Returns None if filters could change the result."""
+        fmt = self.col._qaFormat("q", t['qfmt'], t['ord'])
+        if not self._plainFilters(fmt):
+            return None
+        # the fields _renderQA() adds
+        extra = dict(Tags="", Type=m['name'], Card=t['name'],
+                     Deck=self.col.decks.name(1))
+        extra['c%d' % (t['ord']+1)] = "1"
+        key = (fmt, tuple(flds), repr(sorted(extra.items())))
+        if key in _reqCache:
+            return _reqCache[key]
+        def render(vals):
+            fields = dict(zip(flds, vals))
+            fields.update(extra)
+            return anki.template.render(fmt, fields)
+        a = ["ankiflag"] * len(flds)
+        b = [""] * len(flds)
+        empty = render(b)
+        if render(a) == empty:
+            ret = "none", [], []
+        else:
+            ret = 'all', [i for i in range(len(flds))
+                          if "ankiflag" not in render(a[:i] + [""] + a[i+1:])]
+            if not ret[1]:
+                ret = 'any', [i for i in range(len(flds))
+                              if render(b[:i] + ["1"] + b[i+1:]) != empty]
+        if len(_reqCache) > 1000:
+            _reqCache.clear()
+        _reqCache[key] = ret
+        return ret
+
+    def _plainFilters(self, fmt):
+        "True if only filters that don't affect required fields apply to FMT."
+        hooks = anki.hooks._hooks
+        if hooks.get("mungeFields"):
+            return False
+        for func in hooks.get("mungeQA", []):
+            if func != anki.latex.mungeQA:
+                return False
+            # latex is replaced by image links
+            for reg in anki.latex.regexps.values():
+                if reg.search(fmt):
+                    return False
+        for hook, funcs in hooks.items():
+            if hook.startswith("fmod_"):
+                for func in funcs:
+                    if func not in _reqSafeFilters:
+                        return False
+        return True
+
     def availOrds(self, m, flds):
         "Given a joined field string, return available template ordinals."
         if m['type'] == MODEL_CLOZE:
             return self._availClozeOrds(m, flds)
-        fields = {}
+        return self._availFromMask(m, self._fieldMask(flds))
+
+    def _fieldMask(self, flds):
+        "Bitmask of the non-empty fields in a joined field string."
+        mask = 0
         for c, f in enumerate(splitFields(flds)):
-            fields[c] = f.strip()
+            if f.strip():
+                mask |= 1 << c
+        return mask
+
+    def _availFromMask(self, m, mask):
+        "Available ordinals for a standard model, given a field bitmask."
         avail = []
         for ord, type, req in m['req']:
-            # unsatisfiable template
-            if type == "none":
-                continue
+            need = 0
+            for idx in req:
+                need |= 1 << idx
             # AND requirement?
-            elif type == "all":
-                ok = True
-                for idx in req:
-                    if not fields[idx]:
-                        # missing and was required
-                        ok = False
-                        break
-                if not ok:
+            if type == "all":
+                if mask & need != need:
                     continue
             # OR requirement?
             elif type == "any":
-                ok = False
-                for idx in req:
-                    if fields[idx]:
-                        ok = True
-                        break
-                if not ok:
+                if not mask & need:
                     continue
+            # unsatisfiable template
+            else:
+                continue
             avail.append(ord)
         return avail
 
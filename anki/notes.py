@@ -7,12 +7,12 @@ from anki.utils import fieldChecksum, intTime, \
 
 class Note(object):
 
-    def __init__(self, col, model=None, id=None):
+    def __init__(self, col, model=None, id=None, row=None):
         assert not (model and id)
         self.col = col
         if id:
             self.id = id
-            self.load()
+            self.load(row)
         else:
             self.id = timestampID(col.db, "notes")
             self.guid = guid64()
@@ -25,7 +25,8 @@ class Note(object):
             self._fmap = self.col.models.fieldMap(self._model)
             self.scm = self.col.scm
 
-    def load(self):
+    def load(self, row=None):
+        "Load from the DB, or from ROW if it has already been fetched."
         (self.guid,
          self.mid,
          self.mod,
@@ -33,7 +34,7 @@ class Note(object):
          self.tags,
          self.fields,
          self.flags,
-         self.data) = self.col.db.first("""
+         self.data) = row or self.col.db.first("""
 select guid, mid, mod, usn, tags, flds, flags, data
 from notes where id = ?""", self.id)
         self.fields = splitFields(self.fields)
@@ -62,6 +63,8 @@ insert or replace into notes values (?,?,?,?,?,?,?,?,?,?,?)""",
                             self.mod, self.usn, tags,
                             fields, sfld, csum, self.flags,
                             self.data)
+        self.col.updateSearchIndex([self.id])
+        self.col.media.updateRefs([self.id])
         self.col.tags.register(self.tags)
         self._postFlush()
 
@@ -9,7 +9,8 @@ import itertools
 from operator import itemgetter
 from heapq import *
 
-#from anki.cards import Card
+import anki.cards
+import anki.notes
 from anki.utils import ids2str, intTime, fmtTimeSpan
 from anki.lang import _
 from anki.consts import *
@@ -32,6 +33,9 @@ class Scheduler(object):
         self.reps = 0
         self.today = None
         self._haveQueues = False
+        self._dueCache = None
+        self._changesBefore = None
+        self.prefetcher = SessionPrefetcher(col)
         self._updateCutoff()
 
     def getCard(self):
@@ -49,6 +53,7 @@ class Scheduler(object):
             return card
 
     def reset(self):
+        self.prefetcher.clear()
         self._updateCutoff()
         self._resetLrn()
         self._resetRev()
@@ -58,6 +63,10 @@ class Scheduler(object):
     def answerCard(self, card, ease):
         self.col.log()
         assert ease >= 1 and ease <= 4
+        # note where the card was, so cached deck counts can be refreshed
+        dids = (card.did, card.odid)
+        cached = self._dueCacheValid()
+        prefetched = self.prefetcher.valid()
         self.col.markReview(card)
         if self._burySiblingsOnAnswer:
             self._burySiblings(card)
@@ -93,6 +102,10 @@ class Scheduler(object):
         card.mod = intTime()
         card.usn = self.col.usn()
         card.flushSched()
+        if cached:
+            self._cardAnswered(card, dids)
+        if prefetched:
+            self.prefetcher.answered(card)
 
     def counts(self, card=None):
         counts = [self.newCount, self.lrnCount, self.revCount]
@@ -180,15 +193,24 @@ order by due""" % self._deckLimit(),
             g['revToday'][1] -= rev
             self.col.decks.save(g)
 
-    def _walkingCount(self, limFn=None, cntFn=None):
+    def _walkingCount(self, limFn=None, cntFn=None, cntSql=None, **args):
+        """Total of the active decks' counts, respecting parent limits.
+If CNTSQL is given, all decks are counted in one query instead of calling
+CNTFN for each deck; see _cappedCounts()."""
         tot = 0
         pcounts = {}
+        # early alphas were setting the active ids as a str
+        dids = [int(did) for did in self.col.decks.active()]
+        # get the individual decks' limits
+        lims = dict((did, limFn(self.col.decks.get(did))) for did in dids)
+        if cntSql:
+            cnts = self._cappedCounts(
+                [(did, lims[did]) for did in dids if lims[did]],
+                cntSql, **args)
+            cntFn = lambda did, lim: min(cnts.get(did, 0), lim)
         # for each of the active decks
-        for did in self.col.decks.active():
-            # early alphas were setting the active ids as a str
-            did = int(did)
-            # get the individual deck's limit
-            lim = limFn(self.col.decks.get(did))
+        for did in dids:
+            lim = lims[did]
             if not lim:
                 continue
             # check the parents
@@ -210,16 +232,33 @@ order by due""" % self._deckLimit(),
             tot += cnt
         return tot
 
+    def _cappedCounts(self, lims, where, **args):
+        """Count cards matching WHERE in each deck of LIMS, a list of (did,
+lim), counting no more than lim cards per deck. Returns {did: count}."""
+        cnts = {}
+        # sqlite limits the number of terms in a compound select
+        for i in range(0, len(lims), 250):
+            sql = " union all ".join(["""
+select %d, count() from (select 1 from cards where did = %d and %s limit %d)""" % (
+                did, did, where, lim) for (did, lim) in lims[i:i+250]])
+            cnts.update(self.col.db.all(sql, **args))
+        return cnts
+
     # Deck list
     ##########################################################################
 
     def deckDueList(self):
         "Returns [deckname, did, rev, lrn, new]"
+        return self._deckDueData()[0]
+
+    def _deckDueData(self):
+        "Returns (deckDueList(), {did: (newLimit, revLimit)})."
         self._checkDay()
-        self.col.decks.recoverOrphans()
         decks = self.col.decks.all()
+        counts = self._deckCounts(decks)
         decks.sort(key=itemgetter('name'))
         lims = {}
+        single = {}
         data = []
         def parent(name):
             parts = name.split("::")
@@ -232,44 +271,50 @@ order by due""" % self._deckLimit(),
             # invalid duplicate and reload
             if deck['name'] in lims:
                 self.col.decks.rem(deck['id'], cardsToo=False, childrenToo=True)
-                return self.deckDueList()
+                return self._deckDueData()
             p = parent(deck['name'])
+            cnt = counts.get(deck['id'], (0, 0, 0))
             # new
             nlim = self._deckNewLimitSingle(deck)
+            if deck['dyn']:
+                single[deck['id']] = (None, None)
+            else:
+                single[deck['id']] = (nlim, self._deckRevLimitSingle(deck))
             if p:
                 if p not in lims:
                     # if parent was missing, this deck is invalid, and we
                     # need to reload the deck list
                     self.col.decks.rem(deck['id'], cardsToo=False, childrenToo=True)
-                    return self.deckDueList()
+                    return self._deckDueData()
                 nlim = min(nlim, lims[p][0])
-            new = self._newForDeck(deck['id'], nlim)
+            new = min(cnt[0], nlim, self.reportLimit)
             # learning
-            lrn = self._lrnForDeck(deck['id'])
+            lrn = cnt[1]
             # reviews
             rlim = self._deckRevLimitSingle(deck)
             if p:
                 rlim = min(rlim, lims[p][1])
-            rev = self._revForDeck(deck['id'], rlim)
+            rev = min(cnt[2], rlim, self.reportLimit)
             # save to list
             data.append([deck['name'], deck['id'], rev, lrn, new])
             # add deck as a parent
             lims[deck['name']] = [nlim, rlim]
-        return data
+        return data, single
 
     def deckDueTree(self):
-        return self._groupChildren(self.deckDueList())
+        data, lims = self._deckDueData()
+        return self._groupChildren(data, lims)
 
-    def _groupChildren(self, grps):
+    def _groupChildren(self, grps, lims=None):
         # first, split the group names into components
         for g in grps:
             g[0] = g[0].split("::")
         # and sort based on those components
         grps.sort(key=itemgetter(0))
         # then run main function
-        return self._groupChildrenMain(grps)
+        return self._groupChildrenMain(grps, lims)
 
-    def _groupChildrenMain(self, grps):
+    def _groupChildrenMain(self, grps, lims=None):
         tree = []
         # group and recurse
         def key(grp):
@@ -292,21 +337,141 @@ order by due""" % self._deckLimit(),
                     # set new string to tail
                     c[0] = c[0][1:]
                     children.append(c)
-            children = self._groupChildrenMain(children)
+            children = self._groupChildrenMain(children, lims)
             # tally up children counts
             for ch in children:
                 rev += ch[2]
                 lrn += ch[3]
                 new += ch[4]
             # limit the counts to the deck's limits
-            conf = self.col.decks.confForDid(did)
-            deck = self.col.decks.get(did)
-            if not conf['dyn']:
-                rev = max(0, min(rev, conf['rev']['perDay']-deck['revToday'][1]))
-                new = max(0, min(new, conf['new']['perDay']-deck['newToday'][1]))
+            if lims is not None and did in lims:
+                nlim, rlim = lims[did]
+            else:
+                conf = self.col.decks.confForDid(did)
+                deck = self.col.decks.get(did)
+                if conf['dyn']:
+                    nlim = rlim = None
+                else:
+                    nlim = conf['new']['perDay']-deck['newToday'][1]
+                    rlim = conf['rev']['perDay']-deck['revToday'][1]
+            if rlim is not None:
+                rev = max(0, min(rev, rlim))
+                new = max(0, min(new, nlim))
             tree.append((head, did, rev, lrn, new, children))
         return tuple(tree)
 
+    # Cached per-deck counts
+    ##########################################################################
+
+    # Raw (unlimited) due counts per deck are gathered with one grouped scan
+    # of ix_cards_sched, and then kept until something other than a tracked
+    # card write touches the DB. Card.flush() and answerCard() mark the decks
+    # they touch as dirty, so that only those decks are counted again.
+
+    def _deckCounts(self, decks):
+        "Return {did: (new, lrn, rev)}, without deck limits applied."
+        c = self._dueCache
+        dids = set(d['id'] for d in decks)
+        if not c or c['dids'] != dids:
+            # removed decks may have left orphans behind
+            self.col.decks.recoverOrphans()
+        if not self._dueCacheValid():
+            c = self._dueCache = dict(
+                counts={}, dirty=set(), today=self.today,
+                changes=None, dids=dids)
+            self._fillDeckCounts(c)
+        else:
+            c['dids'] = dids
+            # learning cards that have become due since the last count
+            cutoff = intTime() + self.col.conf['collapseTime']
+            for did, cnt in c['counts'].items():
+                if cnt[3] is not None and cnt[3] < cutoff:
+                    c['dirty'].add(did)
+            if c['dirty']:
+                self._fillDeckCounts(c, c['dirty'])
+        return c['counts']
+
+    def _dueCacheValid(self):
+        c = self._dueCache
+        return bool(c and c['today'] == self.today and
+                    c['changes'] == self.col.db.totalChanges())
+
+    def _fillDeckCounts(self, c, dids=None):
+        cutoff = intTime() + self.col.conf['collapseTime']
+        if dids is None:
+            lim = ""
+        else:
+            lim = "and did in " + ids2str(dids)
+            for did in dids:
+                c['counts'].pop(did, None)
+        counts = c['counts']
+        for did, queue, cnt, left, nextDue in self.col.db.execute("""
+select did, queue,
+sum(case queue when 0 then 1 when 1 then due < :cut else due <= :today end),
+sum(case when queue = 1 and due < :cut then left/1000 else 0 end),
+min(case when queue = 1 and due >= :cut then due end)
+from cards where queue between 0 and 3 %s
+group by did, queue""" % lim, cut=cutoff, today=self.today):
+            if did not in counts:
+                counts[did] = [0, 0, 0, None]
+            cur = counts[did]
+            if queue == 0:
+                cur[0] = cnt
+            elif queue == 2:
+                cur[2] = cnt
+            elif queue == 1:
+                if cnt > self.reportLimit:
+                    # only the first reportLimit cards are summed
+                    left = self.col.db.scalar("""
+select sum(left/1000) from
+(select left from cards where did = ? and queue = 1 and due < ? limit ?)""",
+                        did, cutoff, self.reportLimit) or 0
+                cur[1] += left
+                cur[3] = nextDue
+            else:
+                cur[1] += min(cnt, self.reportLimit)
+        c['dirty'] = set()
+        c['changes'] = self.col.db.totalChanges()
+
+    def _clearDeckCounts(self):
+        "Throw away cached deck counts; called when the DB is rolled back."
+        self._dueCache = None
+
+    def _cardChanging(self, card):
+        "Called before a single-row write of CARD."
+        self.prefetcher.cardChanging(card)
+        self._changesBefore = self.col.db.totalChanges()
+        if not self._dueCacheValid():
+            return
+        c = self._dueCache
+        old = self.col.db.first(
+            "select did, odid from cards where id = ?", card.id) or ()
+        c['dirty'].update(old)
+        c['dirty'].update((card.did, card.odid))
+        c['dirty'].discard(0)
+
+    def _cardChanged(self):
+        """Called after the write announced by _cardChanging(). Triggers may
+make a write count as several changes, so the new total is read back."""
+        before = self._changesBefore
+        now = self.col.db.totalChanges()
+        c = self._dueCache
+        if c and c['changes'] == before:
+            c['changes'] = now
+        self.prefetcher.cardChanged(before, now)
+
+    def _cardAnswered(self, card, dids):
+        "Mark decks touched by answering CARD as dirty. DIDS were its decks before."
+        c = self._dueCache
+        # buried siblings may live in other decks
+        dirty = set(dids)
+        dirty.update(self.col.db.list(
+            "select did from cards where nid = ?", card.nid))
+        dirty.update((card.did, card.odid))
+        dirty.discard(0)
+        c['dirty'].update(dirty)
+        c['changes'] = self.col.db.totalChanges()
+
     # Getting the next card
     ##########################################################################
 
@@ -336,14 +501,24 @@ order by due""" % self._deckLimit(),
         # collapse or finish
         return self._getLrnCard(collapse=True)
 
+    def prefetchCards(self):
+        """Load and render the cards likely to be shown next. The GUI calls
+this while the user is looking at the answer."""
+        if not self._haveQueues:
+            return
+        lim = self.prefetcher.size
+        cids = [id for (due, id) in self._lrnQueue[:lim]]
+        for q in self._revQueue, self._newQueue, self._lrnDayQueue:
+            # cards are popped from the end
+            cids.extend(reversed(q[-lim:]))
+        self.prefetcher.prefetch(cids)
+
     # New cards
     ##########################################################################
 
     def _resetNewCount(self):
-        cntFn = lambda did, lim: self.col.db.scalar("""
-select count() from (select 1 from cards where
-did = ? and queue = 0 limit ?)""", did, lim)
-        self.newCount = self._walkingCount(self._deckNewLimitSingle, cntFn)
+        self.newCount = self._walkingCount(
+            self._deckNewLimitSingle, cntSql="queue = 0")
 
     def _resetNew(self):
         self._resetNewCount()
@@ -378,7 +553,7 @@ select id from cards where did = ? and queue = 0 order by due limit ?""", did, l
     def _getNewCard(self):
         if self._fillNew():
             self.newCount -= 1
-            return self.col.getCard(self._newQueue.pop())
+            return self.prefetcher.getCard(self._newQueue.pop())
 
     def _updateNewCardRatio(self):
         if self.col.conf['newSpread'] == NEW_CARDS_DISTRIBUTE:
@@ -482,7 +657,7 @@ limit %d""" % (self._deckLimit(), self.reportLimit), lim=self.dayCutoff)
                 cutoff += self.col.conf['collapseTime']
             if self._lrnQueue[0][0] < cutoff:
                 id = heappop(self._lrnQueue)[1]
-                card = self.col.getCard(id)
+                card = self.prefetcher.getCard(id)
                 self.lrnCount -= card.left // 1000
                 return card
 
@@ -514,7 +689,7 @@ did = ? and queue = 3 and due <= ? limit ?""",
     def _getLrnDayCard(self):
         if self._fillLrnDay():
             self.lrnCount -= 1
-            return self.col.getCard(self._lrnDayQueue.pop())
+            return self.prefetcher.getCard(self._lrnDayQueue.pop())
 
     def _answerLrnCard(self, card, ease):
         # ease 1=no, 2=yes, 3=remove
@@ -734,13 +909,9 @@ and due <= ? limit ?)""",
             did, self.today, lim)
 
     def _resetRevCount(self):
-        def cntFn(did, lim):
-            return self.col.db.scalar("""
-select count() from (select id from cards where
-did = ? and queue = 2 and due <= ? limit %d)""" % lim,
-                                      did, self.today)
         self.revCount = self._walkingCount(
-            self._deckRevLimitSingle, cntFn)
+            self._deckRevLimitSingle, cntSql="queue = 2 and due <= :today",
+            today=self.today)
 
     def _resetRev(self):
         self._resetRevCount()
@@ -787,7 +958,7 @@ did = ? and queue = 2 and due <= ? limit ?""",
     def _getRevCard(self):
         if self._fillRev():
             self.revCount -= 1
-            return self.col.getCard(self._revQueue.pop())
+            return self.prefetcher.getCard(self._revQueue.pop())
 
     def totalRevForCurrentDeck(self):
         return self.col.db.scalar(
@@ -1442,3 +1613,89 @@ and due >= ? and queue = 0""" % scids, now, self.col.usn(), shiftby, low)
         # in order due?
         if conf['new']['order'] == NEW_CARDS_RANDOM:
             self.randomizeCards(did)
+
+# Prefetching
+##########################################################################
+
+class SessionPrefetcher(object):
+    """Keeps upcoming cards, their notes and their rendered Q/A in memory, so
+the next card can be shown without going to the DB.
+
+The cached data is only used while no other writes have been made to the DB.
+Card.flush() and answerCard() report their own writes and drop the cards
+they changed; anything else (editing, burying, syncing, etc) discards it."""
+
+    def __init__(self, col, size=10):
+        self.col = col
+        self.size = size
+        self.clear()
+
+    def clear(self):
+        # cid -> (card row, note row, q/a)
+        self._cards = {}
+        # least recently used first
+        self._order = []
+        self._changes = None
+
+    def valid(self):
+        return (self._changes is not None and
+                self._changes == self.col.db.totalChanges())
+
+    def prefetch(self, cids):
+        "Load CIDS and their notes in one query, and render them."
+        if not self.valid():
+            self.clear()
+        cids = [id for id in cids if id not in self._cards][:self.size]
+        if not cids:
+            return
+        for row in self.col.db.execute("""
+select c.*, n.guid, n.mid, n.mod, n.usn, n.tags, n.flds, n.flags, n.data
+from cards c, notes n where c.nid = n.id and c.id in %s""" % ids2str(cids)):
+            crow = row[:18]
+            nrow = row[18:]
+            card = self._card(crow, nrow)
+            self._cards[card.id] = (crow, nrow, card._getQA())
+            self._order.append(card.id)
+        # drop the least recently used cards
+        for id in self._order[:-self.size]:
+            del self._cards[id]
+        del self._order[:-self.size]
+        self._changes = self.col.db.totalChanges()
+
+    def getCard(self, id):
+        "Return card ID, from memory if possible."
+        if id not in self._cards or not self.valid():
+            return self.col.getCard(id)
+        crow, nrow, qa = self._cards[id]
+        self._order.remove(id)
+        self._order.append(id)
+        card = self._card(crow, nrow)
+        card._qa = dict(qa)
+        return card
+
+    def _card(self, crow, nrow):
+        card = anki.cards.Card(self.col, crow[0], crow)
+        card._note = anki.notes.Note(self.col, id=crow[1], row=nrow)
+        return card
+
+    def discard(self, ids):
+        for id in ids:
+            if id in self._cards:
+                del self._cards[id]
+                self._order.remove(id)
+
+    def cardChanging(self, card):
+        "Called before a single-row write of CARD."
+        self.discard([card.id])
+
+    def cardChanged(self, before, now):
+        "Called after the write, which took the db from BEFORE to NOW changes."
+        if self._changes == before:
+            self._changes = now
+
+    def answered(self, card):
+        "Drop CARD and its siblings, which may have been buried."
+        self.discard([id for id, (crow, nrow, qa) in self._cards.items()
+                      if crow[1] == card.nid])
+        self.discard([card.id])
+        self._changes = self.col.db.totalChanges()
@@ -6,11 +6,23 @@ import urllib
 import sys
 import gzip
 import random
+import time
+import threading
+import Queue
+import zipfile
+import zlib
+import tempfile
+import shutil
+import struct
+import select
 from cStringIO import StringIO
+from hashlib import sha1
 
+import httplib
 import httplib2
 from anki.db import DB
-from anki.utils import ids2str, intTime, json, isWin, isMac, platDesc, checksum
+from anki.utils import ids2str, intTime, json, isWin, isMac, platDesc, \
+    checksum, checksumFile
 from anki.consts import *
 from hooks import runHook
 import anki
@@ -20,6 +32,18 @@ from lang import ngettext
 HTTP_TIMEOUT = 90
 HTTP_PROXY = None
 
+# client chunks are sized to take about this many seconds to apply,
+# within these bounds
+SYNC_CHUNK_TIME = 2.0
+SYNC_CHUNK_BYTES = 5*1024*1024
+SYNC_CHUNK_MIN = 250
+SYNC_CHUNK_MAX = 10000
+# full syncs with a delta-capable server send only the changed blocks of the
+# collection file; this matches the page size of new collections
+FULL_SYNC_BLOCK = 4096
+# seconds between full integrity checks when syncing
+SYNC_FULL_CHECK_INTERVAL = 86400
+
 # badly named; means no retries
 httplib2.RETRIES = 1
 
@@ -35,6 +59,80 @@ except AttributeError:
 # Httplib2 connection object
 ######################################################################
 
+# request bodies larger than this are spooled to disk
+HTTP_SPOOL_SIZE = 1024*1024
+# connections kept by the shared pool, and seconds an idle one is kept open
+HTTP_POOL_SIZE = 4
+HTTP_POOL_IDLE = 300
+
+class _StreamingHttp(httplib2.Http):
+    """An Http object that can write a successful response to a file
+instead of reading it into memory. Set streamTo before a request.
+Like the desktop client's httplib2 patch, streamed responses fire httpRecv
+as data arrives, and a request is retried once if a kept-alive connection
+turns out to have been closed."""
+
+    streamTo = None
+    # requests made, and how many of them went over an open connection
+    requests = 0
+    reused = 0
+
+    def _conn_request(self, conn, request_uri, method, body, headers):
+        self.requests += 1
+        if conn.sock is not None:
+            self.reused += 1
+        if not self.streamTo:
+            return httplib2.Http._conn_request(
+                self, conn, request_uri, method, body, headers)
+        for i in range(2):
+            if hasattr(body, "seek"):
+                # a retry must send the whole body again
+                body.seek(0)
+            try:
+                if conn.sock is None:
+                    conn.connect()
+                conn.request(method, request_uri, body, headers)
+                resp = conn.getresponse()
+            except httplib.BadStatusLine:
+                conn.close()
+                if i:
+                    raise
+                continue
+            except:
+                conn.close()
+                raise
+            break
+        response = httplib2.Response(resp)
+        if resp.status != 200:
+            # errors are small, so let the caller handle them as usual
+            return response, resp.read()
+        # decompress as it arrives
+        encoding = response.get('content-encoding')
+        if encoding == "gzip":
+            dec = zlib.decompressobj(16+zlib.MAX_WBITS)
+        elif encoding == "deflate":
+            dec = zlib.decompressobj()
+        else:
+            dec = None
+        size = 0
+        while True:
+            data = resp.read(65536)
+            if not data:
+                break
+            runHook("httpRecv", len(data))
+            if dec:
+                data = dec.decompress(data)
+            self.streamTo.write(data)
+            size += len(data)
+        if dec:
+            data = dec.flush()
+            self.streamTo.write(data)
+            size += len(data)
+            response['-content-encoding'] = encoding
+            del response['content-encoding']
+        response['content-length'] = str(size)
+        return response, ""
+
 def httpCon():
     certs = os.path.join(os.path.dirname(__file__), "ankiweb.certs")
     if not os.path.exists(certs):
@@ -48,11 +146,104 @@ def httpCon():
                 "../Resources/ankiweb.certs")
         else:
             assert 0, "Your distro has not packaged Anki correctly."
-    return httplib2.Http(
+    return _StreamingHttp(
         timeout=HTTP_TIMEOUT, ca_certs=certs,
         proxy_info=HTTP_PROXY,
         disable_ssl_certificate_validation=not not HTTP_PROXY)
 
+# Connection pool
+######################################################################
+# Syncers share a pool of connections by default, so the collection, full
+# and media syncs, and later syncs in the same session, can reuse connections
+# the server has kept alive instead of setting up TLS each time.
+
+class HttpPool(object):
+    "A thread-safe pool of up to SIZE Http objects from FACTORY."
+
+    def __init__(self, size=HTTP_POOL_SIZE, idle=HTTP_POOL_IDLE,
+                 factory=None):
+        self.idle = idle
+        self.factory = factory or httpCon
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(size)
+        # (last used, con), most recently used last
+        self._free = []
+        self._cons = []
+
+    def get(self):
+        "Return a connection, waiting for one if all are in use."
+        self._slots.acquire()
+        self._lock.acquire()
+        try:
+            if self._free:
+                last, con = self._free.pop()
+            else:
+                last, con = None, None
+        finally:
+            self._lock.release()
+        if con:
+            self._dropStale(con, last)
+            return con
+        try:
+            con = self.factory()
+        except:
+            self._slots.release()
+            raise
+        self._lock.acquire()
+        self._cons.append(con)
+        self._lock.release()
+        return con
+
+    def put(self, con, ok=True):
+        "Return CON to the pool. If not OK, its sockets are closed first."
+        if not ok:
+            self._closeCon(con)
+        self._lock.acquire()
+        self._free.append((time.time(), con))
+        self._lock.release()
+        self._slots.release()
+
+    def stats(self):
+        "Requests and reused connection counts for each connection made."
+        self._lock.acquire()
+        try:
+            return [dict(requests=getattr(c, "requests", 0),
+                         reused=getattr(c, "reused", 0))
+                    for c in self._cons]
+        finally:
+            self._lock.release()
+
+    def close(self):
+        "Close idle connections."
+        self._lock.acquire()
+        try:
+            for last, con in self._free:
+                self._closeCon(con)
+        finally:
+            self._lock.release()
+
+    def _dropStale(self, con, last):
+        # a socket is readable when idle only if the server has closed it
+        expired = time.time() - last > self.idle
+        for conn in con.connections.values():
+            if conn.sock is None:
+                continue
+            if expired or select.select([conn.sock], [], [], 0)[0]:
+                conn.close()
+
+    def _closeCon(self, con):
+        for conn in con.connections.values():
+            conn.close()
+
+_httpPool = None
+
+def httpPool():
+    "The pool shared by syncers that aren't given a connection."
+    global _httpPool
+    if not _httpPool:
+        _httpPool = HttpPool()
+    return _httpPool
+
 # Proxy handling
 ######################################################################
 
@@ -97,6 +288,7 @@ class Syncer(object):
     def __init__(self, col, server=None):
         self.col = col
         self.server = server
+        self.fullCheck = True
 
     def sync(self):
         "Returns 'noChanges', 'fullSync', 'success', etc"
@@ -105,6 +297,8 @@ class Syncer(object):
         # if the deck has any pending changes, flush them first and bump mod
         # time
         self.col.save()
+        self.prepareToMerge()
+        self.fullCheck = self.fullCheckDue()
         # step 1: login & metadata
         runHook("sync", "login")
         meta = self.server.meta()
@@ -145,7 +339,7 @@ class Syncer(object):
             return "fullSync"
         self.lnewer = self.lmod > self.rmod
         # step 1.5: check collection is valid
-        if not self.col.basicCheck():
+        if self.fullCheck and not self.col.basicCheck():
             self.col.log("basic check")
             return "basicCheckFailed"
         # step 2: deletions
@@ -160,22 +354,10 @@ class Syncer(object):
         self.mergeChanges(lchg, rchg)
         # step 3: stream large tables from server
         runHook("sync", "server")
-        while 1:
-            runHook("sync", "stream")
-            chunk = self.server.chunk()
-            self.col.log("server chunk", chunk)
-            self.applyChunk(chunk=chunk)
-            if chunk['done']:
-                break
+        self.streamFromServer()
         # step 4: stream to server
         runHook("sync", "client")
-        while 1:
-            runHook("sync", "stream")
-            chunk = self.chunk()
-            self.col.log("client chunk", chunk)
-            self.server.applyChunk(chunk=chunk)
-            if chunk['done']:
-                break
+        self.streamToServer()
         # step 5: sanity check
         runHook("sync", "sanity")
         c = self.sanityCheck()
@@ -232,12 +414,17 @@ class Syncer(object):
             self.col.crt = rchg['crt']
         self.prepareToChunk()
 
+    def fullCheckDue(self):
+        "True if the slower integrity checks should be run on this sync."
+        return bool(os.getenv("ANKIDEV")) or (
+            time.time() - self.col.lastFullCheck > SYNC_FULL_CHECK_INTERVAL)
+
     def sanityCheck(self):
-        if not self.col.basicCheck():
+        if self.fullCheck and not self.col.basicCheck():
             return "failed basic check"
         for t in "cards", "notes", "revlog", "graves":
             if self.col.db.scalar(
-                "select count() from %s where usn = -1" % t):
+                "select 1 from %s where usn = -1 limit 1" % t):
                 return "%s had usn = -1" % t
         for g in self.col.decks.all():
             if g['usn'] == -1:
@@ -258,15 +445,18 @@ class Syncer(object):
         if found:
             self.col.models.save()
         self.col.sched.reset()
-        # check for missing parent decks
-        self.col.sched.deckDueList()
+        if self.fullCheck:
+            # check for missing parent decks
+            self.col.sched.deckDueList()
+            self.col.lastFullCheck = time.time()
         # return summary of deck
+        rows = self.col.rowCounts()
         return [
             list(self.col.sched.counts()),
-            self.col.db.scalar("select count() from cards"),
-            self.col.db.scalar("select count() from notes"),
-            self.col.db.scalar("select count() from revlog"),
-            self.col.db.scalar("select count() from graves"),
+            rows['cards'],
+            rows['notes'],
+            rows['revlog'],
+            rows['graves'],
             len(self.col.models.all()),
             len(self.col.decks.all()),
             len(self.col.decks.allConf()),
@@ -301,6 +491,9 @@ class Syncer(object):
     def prepareToChunk(self):
         self.tablesLeft = ["revlog", "cards", "notes"]
         self.cursor = None
+        self.chunkSize = 2500
+        self.stats = dict(rows=0, bytes=0, secs=0.0,
+                          rowsPerSec=0.0, bytesPerSec=0.0)
 
     def cursorForTable(self, table):
         lim = self.usnLim()
@@ -321,7 +514,7 @@ from notes where %s""" % d)
 
     def chunk(self):
         buf = dict(done=False)
-        lim = 2500
+        lim = self.chunkSize
         while self.tablesLeft and lim:
             curTable = self.tablesLeft[0]
             if not self.cursor:
@@ -343,6 +536,82 @@ from notes where %s""" % d)
             buf['done'] = True
         return buf
 
+    def streamFromServer(self):
+        # over http, the next chunk is fetched while this one is applied;
+        # a local server's db can only be used from this thread
+        chunks = self._serverChunks()
+        if isinstance(self.server, HttpSyncer):
+            chunks = _Pipeline(chunks)
+        try:
+            for chunk, bytes, secs in chunks:
+                runHook("sync", "stream")
+                self.col.log("server chunk", chunk)
+                self.applyChunk(chunk=chunk)
+                self._chunkStats(chunk, bytes, secs)
+        finally:
+            if isinstance(chunks, _Pipeline):
+                chunks.close()
+
+    def _serverChunks(self):
+        "Yield (chunk, bytes received, seconds taken) for each server chunk."
+        while 1:
+            t = time.time()
+            chunk = self.server.chunk()
+            # read before the next chunk is fetched
+            yield (chunk, getattr(self.server, "lastRecv", 0),
+                   time.time() - t)
+            if chunk['done']:
+                break
+
+    def streamToServer(self):
+        # the next chunk is gathered while the server applies this one
+        sending = None
+        while 1:
+            runHook("sync", "stream")
+            chunk = self.chunk()
+            self.col.log("client chunk", chunk)
+            if sending:
+                self._chunkSent(*sending.wait())
+            sending = _Background(self._sendChunk, chunk,
+                                  isinstance(self.server, HttpSyncer))
+            if chunk['done']:
+                break
+        self._chunkSent(*sending.wait())
+
+    def _sendChunk(self, chunk):
+        t = time.time()
+        self.server.applyChunk(chunk=chunk)
+        return (chunk, getattr(self.server, "lastSent", 0),
+                time.time() - t)
+
+    def _chunkSent(self, chunk, bytes, secs):
+        rows = self._chunkStats(chunk, bytes, secs)
+        if not rows or secs <= 0:
+            return
+        # aim for SYNC_CHUNK_TIME per round trip, at most doubling or
+        # halving each time
+        size = rows * SYNC_CHUNK_TIME / secs
+        if bytes:
+            size = min(size, rows * SYNC_CHUNK_BYTES / float(bytes))
+        size = max(self.chunkSize / 2, min(self.chunkSize * 2, size))
+        self.chunkSize = int(max(SYNC_CHUNK_MIN, min(SYNC_CHUNK_MAX, size)))
+
+    def _chunkStats(self, chunk, bytes, secs):
+        """Add a chunk to the transfer stats, returning its row count. Always
+called from the syncing thread."""
+        rows = 0
+        for t in "revlog", "cards", "notes":
+            rows += len(chunk.get(t, []))
+        s = self.stats
+        s['rows'] += rows
+        s['bytes'] += bytes
+        s['secs'] += secs
+        if s['secs']:
+            s['rowsPerSec'] = s['rows'] / s['secs']
+            s['bytesPerSec'] = s['bytes'] / s['secs']
+        runHook("syncStats", s)
+        return rows
+
     def applyChunk(self, chunk):
         if "revlog" in chunk:
             self.mergeRevlog(chunk['revlog'])
@@ -377,6 +646,8 @@ from notes where %s""" % d)
         return dict(cards=cards, notes=notes, decks=decks)
 
     def start(self, minUsn, lnewer, graves):
+        self.prepareToMerge()
+        self.fullCheck = self.fullCheckDue()
         self.maxUsn = self.col._usn
         self.minUsn = minUsn
         self.lnewer = not lnewer
@@ -478,32 +749,43 @@ from notes where %s""" % d)
             "insert or ignore into revlog values (?,?,?,?,?,?,?,?,?)",
             logs)
 
-    def newerRows(self, data, table, modIdx):
-        ids = (r[0] for r in data)
-        lmods = {}
-        for id, mod in self.col.db.execute(
-            "select id, mod from %s where id in %s and %s" % (
-                table, ids2str(ids), self.usnLim())):
-            lmods[id] = mod
-        update = []
-        for r in data:
-            if r[0] not in lmods or lmods[r[0]] < r[modIdx]:
-                update.append(r)
+    def prepareToMerge(self):
+        """Create temp tables that incoming cards and notes are loaded into.
+Call when no changes are pending, as sqlite commits before creating tables."""
+        self.col.prepareRowCounts()
+        for table in "cards", "notes":
+            self.col.db.execute("""
+create temp table if not exists merge_%s as select * from %s where 0""" % (
+                table, table))
+        self._mergeReady = True
+
+    def mergeRows(self, data, table):
+        """Replace rows in TABLE with the rows in DATA that are newer than any
+local changes to them, and return the ids that were replaced."""
         self.col.log(table, data)
-        return update
+        if not data:
+            return []
+        if not getattr(self, "_mergeReady", False):
+            self.prepareToMerge()
+        db = self.col.db
+        tmp = "merge_" + table
+        db.execute("delete from " + tmp)
+        db.executemany("insert into %s values (%s)" % (
+            tmp, ",".join("?"*len(data[0]))), data)
+        # incoming rows win unless we have a newer change to the same id
+        newer = """
+from %s t left join %s l on l.id = t.id and l.%s
+where l.id is null or l.mod < t.mod""" % (tmp, table, self.usnLim())
+        ids = db.list("select t.id" + newer)
+        db.execute("insert or replace into %s select t.*%s" % (table, newer))
+        db.execute("delete from " + tmp)
+        return ids
 
     def mergeCards(self, cards):
-        self.col.db.executemany(
-            "insert or replace into cards values "
-            "(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)",
-            self.newerRows(cards, "cards", 4))
+        self.mergeRows(cards, "cards")
 
     def mergeNotes(self, notes):
-        rows = self.newerRows(notes, "notes", 3)
-        self.col.db.executemany(
-            "insert or replace into notes values (?,?,?,?,?,?,?,?,?,?,?)",
-            rows)
-        self.col.updateFieldCache([f[0] for f in rows])
+        self.col.updateFieldCache(self.mergeRows(notes, "notes"))
 
     # Col config
     ##########################################################################
@@ -538,7 +820,8 @@ class HttpSyncer(object):
     def __init__(self, hkey=None, con=None):
         self.hkey = hkey
         self.skey = checksum(str(random.random()))[:8]
-        self.con = con or httpCon()
+        # an Http object, or an HttpPool to take one from for each request
+        self.con = con or httpPool()
         self.postVars = {}
 
     def assertOk(self, resp):
@@ -551,10 +834,13 @@ class HttpSyncer(object):
     # costly. We could send it as a raw post, but more HTTP clients seem to
     # support file uploading, so this is the more compatible choice.
 
-    def req(self, method, fobj=None, comp=6, badAuthRaises=False):
+    def req(self, method, fobj=None, comp=6, badAuthRaises=False, out=None):
+        """Post FOBJ to METHOD and return the response. If OUT is provided, a
+successful response is written to it instead, and "" is returned."""
         BOUNDARY="Anki-sync-boundary"
         bdry = "--"+BOUNDARY
-        buf = StringIO()
+        # large payloads are spooled to disk rather than held in memory
+        buf = tempfile.SpooledTemporaryFile(max_size=HTTP_SPOOL_SIZE)
         # post vars
         self.postVars['c'] = 1 if comp else 0
         for (key, value) in self.postVars.items():
@@ -583,15 +869,38 @@ Content-Type: application/octet-stream\r\n\r\n""")
                 tgt.write(data)
             buf.write('\r\n' + bdry + '--\r\n')
         size = buf.tell()
+        self.lastSent = size
         # connection headers
         headers = {
             'Content-Type': 'multipart/form-data; boundary=%s' % BOUNDARY,
             'Content-Length': str(size),
         }
-        body = buf.getvalue()
-        buf.close()
-        resp, cont = self.con.request(
-            self.syncURL()+method, "POST", headers=headers, body=body)
+        buf.seek(0)
+        if isinstance(self.con, HttpPool):
+            pool = self.con
+            con = pool.get()
+        else:
+            pool = None
+            con = self.con
+        # only our own Http class can stream the response
+        stream = out and isinstance(con, _StreamingHttp)
+        if stream:
+            con.streamTo = out
+        ok = False
+        try:
+            resp, cont = con.request(
+                self.syncURL()+method, "POST", headers=headers, body=buf)
+            ok = True
+        finally:
+            buf.close()
+            if stream:
+                con.streamTo = None
+            if pool:
+                pool.put(con, ok)
+        if out and not stream and resp['status'] == '200':
+            out.write(cont)
+            cont = ""
+        self.lastRecv = len(cont or "")
         if not badAuthRaises:
             # return false if bad auth instead of raising
             if resp['status'] == '403':
@@ -665,13 +974,15 @@ class RemoteServer(HttpSyncer):
 
 class FullSyncer(HttpSyncer):
 
-    def __init__(self, col, hkey, con):
+    def __init__(self, col, hkey, con, server=None):
         HttpSyncer.__init__(self, hkey, con)
         self.postVars = dict(
             k=self.hkey,
             v="ankidesktop,%s,%s"%(anki.version, platDesc()),
         )
         self.col = col
+        # if provided, a server taking block deltas instead of whole files
+        self.server = server
 
     def syncURL(self):
         if os.getenv("DEV"):
@@ -681,12 +992,21 @@ class FullSyncer(HttpSyncer):
     def download(self):
         runHook("sync", "download")
         self.col.close()
-        cont = self.req("download")
         tpath = self.col.path + ".tmp"
-        if cont == "upgradeRequired":
-            runHook("sync", "upgradeRequired")
-            return
-        open(tpath, "wb").write(cont)
+        if self.server:
+            self._downloadDelta(tpath)
+        else:
+            # the collection is written straight to disk as it arrives
+            out = open(tpath, "wb")
+            try:
+                self.req("download", out=out)
+            finally:
+                out.close()
+            if os.path.getsize(tpath) < 100:
+                if open(tpath, "rb").read() == "upgradeRequired":
+                    os.unlink(tpath)
+                    runHook("sync", "upgradeRequired")
+                    return
         # check the received file is ok
         d = DB(tpath)
         assert d.scalar("pragma integrity_check") == "ok"
@@ -706,10 +1026,150 @@ class FullSyncer(HttpSyncer):
             return False
         # apply some adjustments, then upload
         self.col.beforeUpload()
+        if self.server:
+            return self._uploadDelta()
         if self.req("upload", open(self.col.path, "rb")) != "OK":
             return False
         return True
 
+    def _downloadDelta(self, tpath):
+        buf = tempfile.SpooledTemporaryFile(max_size=HTTP_SPOOL_SIZE)
+        try:
+            self.server.downloadDelta(blockSums(self.col.path), buf)
+            self.lastRecv = buf.tell()
+            buf.seek(0)
+            applyDelta(self.col.path, buf, tpath)
+        finally:
+            buf.close()
+
+    def _uploadDelta(self):
+        buf = tempfile.SpooledTemporaryFile(max_size=HTTP_SPOOL_SIZE)
+        try:
+            writeDelta(self.col.path, self.server.blockSums(), buf)
+            self.lastSent = buf.tell()
+            buf.seek(0)
+            return self.server.uploadDelta(buf) == "OK"
+        finally:
+            buf.close()
+
+# Delta full syncing
+##########################################################################
+# The collection file is compared in page sized blocks. Vacuuming shifts
+# pages around, so each block of the new file is sent either as a run of
+# blocks to copy from anywhere in the old file, or as literal data. An end
+# marker follows, then the size and checksum of the complete file, so the
+# patched copy can be verified before it replaces anything.
+
+_deltaRecord = struct.Struct(">BII")
+_deltaCopy, _deltaData, _deltaEnd = range(3)
+
+def _blocks(path, size):
+    f = open(path, "rb")
+    try:
+        while True:
+            data = f.read(size)
+            if not data:
+                break
+            yield data
+    finally:
+        f.close()
+
+def _blockSum(data):
+    # the whole file checksum catches the odd collision
+    return checksum(data)[:16]
+
+def blockSums(path, size=FULL_SYNC_BLOCK):
+    "Checksum of each SIZE byte block of the file at PATH."
+    return [_blockSum(data) for data in _blocks(path, size)]
+
+def writeDelta(path, sums, out, size=FULL_SYNC_BLOCK):
+    """Write to OUT a delta that turns the file with block checksums SUMS into
+the file at PATH."""
+    have = {}
+    for idx, sum in enumerate(sums):
+        have.setdefault(sum, idx)
+    total = 0
+    h = sha1()
+    # pending run of blocks to copy, as [start, count]
+    run = None
+    for data in _blocks(path, size):
+        h.update(data)
+        total += len(data)
+        idx = have.get(_blockSum(data)) if len(data) == size else None
+        if run and idx == run[0] + run[1]:
+            run[1] += 1
+            continue
+        if run:
+            out.write(_deltaRecord.pack(_deltaCopy, *run))
+            run = None
+        if idx is not None:
+            run = [idx, 1]
+        else:
+            out.write(_deltaRecord.pack(_deltaData, len(data), 0))
+            out.write(data)
+    if run:
+        out.write(_deltaRecord.pack(_deltaCopy, *run))
+    out.write(_deltaRecord.pack(_deltaEnd, 0, 0))
+    out.write(json.dumps(dict(size=total, csum=h.hexdigest())))
+
+def applyDelta(path, fobj, dst, size=FULL_SYNC_BLOCK):
+    """Write the file at PATH patched with the delta read from FOBJ to DST.
+DST is only created once the whole delta has been applied and checked."""
+    part = dst + ".part"
+    src = open(path, "rb")
+    f = open(part, "wb")
+    try:
+        try:
+            while True:
+                kind, a, b = _deltaRecord.unpack(
+                    fobj.read(_deltaRecord.size))
+                if kind == _deltaEnd:
+                    break
+                elif kind == _deltaCopy:
+                    src.seek(a*size)
+                    for i in range(b):
+                        f.write(src.read(size))
+                else:
+                    f.write(fobj.read(a))
+            meta = json.loads(fobj.read())
+        finally:
+            f.close()
+            src.close()
+        if (os.path.getsize(part) != meta['size'] or
+            checksumFile(part) != meta['csum']):
+            raise Exception("SyncError:delta checksum mismatch")
+    except:
+        os.unlink(part)
+        raise
+    if os.path.exists(dst):
+        os.unlink(dst)
+    os.rename(part, dst)
+
+class LocalFullServer(object):
+    "The server side of delta full syncs, for a collection file at PATH."
+
+    def __init__(self, path):
+        self.path = path
+
+    def blockSums(self):
+        return blockSums(self.path)
+
+    def uploadDelta(self, fobj):
+        tpath = self.path + ".tmp"
+        applyDelta(self.path, fobj, tpath)
+        d = DB(tpath)
+        ok = d.scalar("pragma integrity_check") == "ok"
+        d.close()
+        if not ok:
+            os.unlink(tpath)
+            return "corrupt"
+        os.unlink(self.path)
+        os.rename(tpath, self.path)
+        return "OK"
+
+    def downloadDelta(self, sums, out):
+        writeDelta(self.path, sums, out)
+
 # Media syncing
 ##########################################################################
 #
@@ -750,9 +1210,11 @@ class MediaSyncer(object):
                 break
 
             need = []
+            clean = []
             lastUsn = data[-1][1]
+            infos = self.col.media.syncInfos([d[0] for d in data])
             for fname, rusn, rsum in data:
-                lsum, ldirty = self.col.media.syncInfo(fname)
+                lsum, ldirty = infos.get(fname, (None, 0))
                 self.col.log(
                     "check: lsum=%s rsum=%s ldirty=%d rusn=%d fname=%s"%(
                         (lsum and lsum[0:4]),
@@ -768,7 +1230,7 @@ class MediaSyncer(object):
                         need.append(fname)
                     else:
                         self.col.log("have same already")
-                    ldirty and self.col.media.markClean([fname])
+                    ldirty and clean.append(fname)
                 elif lsum:
                     # deleted remotely
                     if not ldirty:
@@ -780,8 +1242,9 @@ class MediaSyncer(object):
                 else:
                     # deleted both sides
                     self.col.log("both sides deleted")
-                    ldirty and self.col.media.markClean([fname])
+                    ldirty and clean.append(fname)
 
+            self.col.media.markClean(clean)
             self._downloadFiles(need)
 
             self.col.log("update last usn to %d"%lastUsn)
@@ -793,32 +1256,41 @@ class MediaSyncer(object):
         updateConflict = False
         toSend = self.col.media.dirtyCount()
         while True:
-            zip, fnames = self.col.media.mediaChangesZip()
-            if not fnames:
+            rows = self.col.media.dirtyMedia()
+            if not rows:
                 break
-
-            runHook("syncMsg", ngettext(
-                "%d media change to upload", "%d media changes to upload", toSend)
-                    % toSend)
-
-            processedCnt, serverLastUsn = self.server.uploadChanges(zip)
-            self.col.media.markClean(fnames[0:processedCnt])
-
-            self.col.log("processed %d, serverUsn %d, clientUsn %d" % (
-                processedCnt, serverLastUsn, lastUsn
-            ))
-
-            if serverLastUsn - processedCnt == lastUsn:
-                self.col.log("lastUsn in sync, updating local")
-                lastUsn = serverLastUsn
-                self.col.media.setLastUsn(serverLastUsn) # commits
-            else:
-                self.col.log("concurrent update, skipping usn update")
-                # commit for markClean
-                self.col.media.db.commit()
-                updateConflict = True
-
-            toSend -= processedCnt
+            # the next zip is built while the current one uploads
+            zips = _Pipeline(self.col.media.mediaZips(rows))
+            try:
+                for zip, fnames in zips:
+                    runHook("syncMsg", ngettext(
+                        "%d media change to upload",
+                        "%d media changes to upload", toSend) % toSend)
+
+                    processedCnt, serverLastUsn = self.server.uploadChanges(
+                        zip)
+                    self.col.media.markClean(fnames[0:processedCnt])
+
+                    self.col.log(
+                        "processed %d, serverUsn %d, clientUsn %d" % (
+                            processedCnt, serverLastUsn, lastUsn))
+
+                    if serverLastUsn - processedCnt == lastUsn:
+                        self.col.log("lastUsn in sync, updating local")
+                        lastUsn = serverLastUsn
+                        self.col.media.setLastUsn(serverLastUsn) # commits
+                    else:
+                        self.col.log("concurrent update, skipping usn update")
+                        # commit for markClean
+                        self.col.media.db.commit()
+                        updateConflict = True
+
+                    toSend -= processedCnt
+                    if processedCnt < len(fnames):
+                        # the rest are still dirty; start again from the db
+                        break
+            finally:
+                zips.close()
 
         if updateConflict:
             self.col.log("restart sync due to concurrent update")
@@ -834,19 +1306,103 @@ class MediaSyncer(object):
 
     def _downloadFiles(self, fnames):
         self.col.log("%d files to fetch"%len(fnames))
+        # the next zip is fetched while the current one is extracted
+        zips = _Pipeline(self._fetchZips(fnames))
+        try:
+            for zipData in zips:
+                cnt = self.col.media.addFilesFromZip(zipData)
+                self.downloadCount += cnt
+                self.col.log("received %d files"%cnt)
+
+                n = self.downloadCount
+                runHook("syncMsg", ngettext(
+                    "%d media file downloaded", "%d media files downloaded", n)
+                        % n)
+        finally:
+            zips.close()
+
+    def _fetchZips(self, fnames):
+        "Yield zips of FNAMES from the server. Runs in another thread."
         while fnames:
             top = fnames[0:SYNC_ZIP_COUNT]
             self.col.log("fetch %s"%top)
             zipData = self.server.downloadFiles(files=top)
-            cnt = self.col.media.addFilesFromZip(zipData)
-            self.downloadCount += cnt
-            self.col.log("received %d files"%cnt)
+            # the server may send fewer files than requested
+            cnt = len([n for n in zipfile.ZipFile(StringIO(zipData)).namelist()
+                       if n != "_meta"])
+            if not cnt:
+                raise Exception("SyncError:no files in media zip")
+            yield zipData
             fnames = fnames[cnt:]
 
-            n = self.downloadCount
-            runHook("syncMsg", ngettext(
-                "%d media file downloaded", "%d media files downloaded", n)
-                    % n)
+class _Background(object):
+    """Run FUNC(ARG) in a background thread if THREAD is true. wait()
+returns the result, or raises its exception in the caller's thread."""
+
+    def __init__(self, func, arg, thread=True):
+        self.func = func
+        self.arg = arg
+        self.thread = None
+        if thread:
+            self.thread = threading.Thread(target=self._run)
+            self.thread.daemon = True
+            self.thread.start()
+        else:
+            self._run()
+
+    def _run(self):
+        try:
+            self.result = True, self.func(self.arg)
+        except:
+            self.result = False, sys.exc_info()
+
+    def wait(self):
+        if self.thread:
+            self.thread.join()
+        ok, ret = self.result
+        if not ok:
+            raise ret[0], ret[1], ret[2]
+        return ret
+
+class _Pipeline(object):
+    """Run generator GEN in a background thread, staying up to SIZE items
+ahead of the caller. Exceptions are raised in the caller's thread."""
+
+    def __init__(self, gen, size=1):
+        self.queue = Queue.Queue(size)
+        self.stopped = False
+        self.thread = threading.Thread(target=self._run, args=(gen,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self, gen):
+        try:
+            for item in gen:
+                self.queue.put((True, item))
+                if self.stopped:
+                    return
+            self.queue.put((False, None))
+        except:
+            self.queue.put((None, sys.exc_info()))
+
+    def __iter__(self):
+        while True:
+            ok, item = self.queue.get()
+            if ok is None:
+                raise item[0], item[1], item[2]
+            elif not ok:
+                return
+            yield item
+
+    def close(self):
+        "Stop the generator after its current item."
+        self.stopped = True
+        while self.thread.isAlive():
+            try:
+                self.queue.get(timeout=0.1)
+            except Queue.Empty:
+                pass
+        self.thread.join()
 
 # Remote media syncing
 ##########################################################################
@@ -22,6 +22,26 @@ def modifier(symbol):
     return set_modifier
 
 
+# Rendering with render_sections() and render_tags() rescans the whole
+# template after every substitution. Instead, each template is parsed once
+# into a list of nodes: literal text (a string), tags ((tag_type, tag_name))
+# and sections ([inverted, section_name, nodes]). Rendering walks the list,
+# keeping the sections whose value says so, and evaluates each tag once.
+# Values containing braces could be picked up as tags by the old loop, so in
+# that case (and for templates the parser can't reproduce exactly, like
+# delimiter changes) the old code path is used instead.
+
+CACHE_LIMIT = 1000
+_compiled = {}
+_regexps = {}
+
+def _cache(cache, key, val):
+    if len(cache) > CACHE_LIMIT:
+        cache.clear()
+    cache[key] = val
+    return val
+
+
 def get_or_attr(obj, name, default=None):
     try:
         return obj[name]
@@ -41,6 +61,9 @@ class Template(object):
     # The regular expression used to find a tag.
     tag_re = None
 
+    # Section names that check for a cloze deletion.
+    cloze_section_re = re.compile(r"c[qa]:(\d+):(.+)")
+
     # Opening tag delimiter
     otag = '{{'
 
@@ -57,14 +80,20 @@ class Template(object):
         template = template or self.template
         context = context or self.context
 
-        template = self.render_sections(template, context)
-        result = self.render_tags(template, context)
+        result = self.render_compiled(template, context)
+        if result is None:
+            template = self.render_sections(template, context)
+            result = self.render_tags(template, context)
         if encoding is not None:
             result = result.encode(encoding)
         return result
 
     def compile_regexps(self):
         """Compiles our section and tag regular expressions."""
+        key = (self.otag, self.ctag)
+        if key in _regexps:
+            self.section_re, self.tag_re = _regexps[key]
+            return
         tags = { 'otag': re.escape(self.otag), 'ctag': re.escape(self.ctag) }
 
         section = r"%(otag)s[\#|^]([^\}]*)%(ctag)s(.+?)%(otag)s/\1%(ctag)s"
@@ -72,6 +101,102 @@ class Template(object):
 
         tag = r"%(otag)s(#|=|&|!|>|\{)?(.+?)\1?%(ctag)s+"
         self.tag_re = re.compile(tag % tags)
+        _regexps[key] = (self.section_re, self.tag_re)
+
+    def render_compiled(self, template, context):
+        """Render TEMPLATE by walking its parsed nodes. Returns None if the
+        result might differ from render_sections() + render_tags()."""
+        if (self.otag, self.ctag) != ('{{', '}}'):
+            return None
+        if template in _compiled:
+            nodes = _compiled[template]
+        else:
+            nodes = _cache(_compiled, template, self.compile(template))
+        if nodes is None:
+            return None
+        parts = []
+        vals = {}
+        if not self.render_nodes(nodes, context, parts, vals):
+            return None
+        result = "".join(parts)
+        if "{" in result or "}" in result:
+            # the old code path could pick up tags in the substituted values
+            for val in vals.values():
+                if "{" in val or "}" in val:
+                    return None
+        return result
+
+    def render_nodes(self, nodes, context, parts, vals):
+        """Append the rendered NODES to PARTS, evaluating each distinct tag
+        once into VALS. False if the old code path is needed."""
+        for node in nodes:
+            kind = node.__class__
+            if kind is tuple:
+                if node not in vals:
+                    try:
+                        val = modifiers[node[0]](self, node[1], context)
+                    except Exception:
+                        # invalid templates and errors are reported by the
+                        # old code path
+                        return False
+                    if not isinstance(val, basestring):
+                        return False
+                    vals[node] = val
+                parts.append(vals[node])
+            elif kind is list:
+                inverted, section_name, inner = node
+                it = self.section_value(section_name, context)
+                if it is not None and not isinstance(it, basestring):
+                    return False
+                if (not not it) != inverted:
+                    if not self.render_nodes(inner, context, parts, vals):
+                        return False
+            else:
+                parts.append(node)
+        return True
+
+    def compile(self, template):
+        """Parse TEMPLATE into nodes, or None if the result of rendering them
+        could differ from the old code path."""
+        nodes = []
+        pos = 0
+        for match in self.section_re.finditer(template):
+            section, section_name, inner = match.group(0, 1, 2)
+            if not self.compile_tags(template[pos:match.start()], nodes):
+                return None
+            inner = self.compile(inner)
+            if inner is None:
+                return None
+            nodes.append([section[2] == '^', section_name.strip(), inner])
+            pos = match.end()
+        if not self.compile_tags(template[pos:], nodes):
+            return None
+        return nodes
+
+    def compile_tags(self, text, nodes):
+        """Append the literal text and tags in TEXT to NODES. False if TEXT
+        has leftover section markers, delimiter changes, or literal braces
+        that could join up with other text into a tag."""
+        pos = 0
+        for match in self.tag_re.finditer(text):
+            tag, tag_type, tag_name = match.group(0, 1, 2)
+            tag_name = tag_name.strip()
+            if tag_type in ('#', '=') or tag_name[:1] in ('^', '/', '|'):
+                return False
+            if not self.compile_text(text[pos:match.start()], nodes):
+                return False
+            nodes.append((tag_type, tag_name))
+            pos = match.end()
+        return self.compile_text(text[pos:], nodes)
+
+    def compile_text(self, text, nodes):
+        if not text:
+            return True
+        if ("{{" in text or "}}" in text or text[0] in "{}"
+            or text[-1] in "{}"):
+            return False
+        nodes.append(text)
+        return True
 
     def render_sections(self, template, context):
         """Expands sections."""
@@ -82,25 +207,11 @@ class Template(object):
 
             section, section_name, inner = match.group(0, 1, 2)
             section_name = section_name.strip()
-
-            # check for cloze
-            m = re.match("c[qa]:(\d+):(.+)", section_name)
-            if m:
-                # get full field text
-                txt = get_or_attr(context, m.group(2), None)
-                m = re.search(clozeReg%m.group(1), txt)
-                if m:
-                    it = m.group(1)
-                else:
-                    it = None
-            else:
-                it = get_or_attr(context, section_name, None)
+            it = self.section_value(section_name, context)
 
             replacer = ''
             # if it and isinstance(it, collections.Callable):
             #     replacer = it(inner)
-            if isinstance(it, basestring):
-                it = stripHTMLMedia(it).strip()
             if it and not hasattr(it, '__iter__'):
                 if section[2] != '^':
                     replacer = inner
@@ -119,6 +230,26 @@ class Template(object):
 
         return template
 
+    def section_value(self, section_name, context):
+        "The value deciding whether a section is shown."
+        # check for cloze
+        m = self.cloze_section_re.match(section_name)
+        if m:
+            # get full field text
+            txt = get_or_attr(context, m.group(2), None)
+            m = re.search(clozeReg%m.group(1), txt)
+            if m:
+                it = m.group(1)
+            else:
+                it = None
+        else:
+            it = get_or_attr(context, section_name, None)
+        if isinstance(it, basestring):
+            # text before any html or entities is never stripped
+            if it.lstrip()[:1] in ("", "<", "&"):
+                it = stripHTMLMedia(it).strip()
+        return it
+
     def render_tags(self, template, context):
         """Renders all the tags in a template for a context."""
         while 1:
@@ -275,6 +275,28 @@ def checksum(data):
         data = data.encode("utf-8")
     return sha1(data).hexdigest()
 
+# how much of a file is held in memory at once when checksumming or copying
+CHUNK_SIZE = 65536
+
+def checksumFile(file, out=None):
+    """Checksum a path or file-like object without reading it all into memory.
+If OUT is provided, the data is also written to it."""
+    if isinstance(file, basestring):
+        f = open(file, "rb")
+        try:
+            return checksumFile(f, out)
+        finally:
+            f.close()
+    h = sha1()
+    while True:
+        data = file.read(CHUNK_SIZE)
+        if not data:
+            break
+        h.update(data)
+        if out:
+            out.write(data)
+    return h.hexdigest()
+
 def fieldChecksum(data):
     # 32 bit unsigned number from first 8 digits of sha1 hash
     return int(checksum(stripHTMLMedia(data).encode("utf-8"))[:8], 16)
@@ -13,6 +13,7 @@ import anki.importing as importing
 from aqt.utils import getOnlyText, getFile, showText, showWarning, openHelp,\
     askUser, tooltip
 from anki.hooks import addHook, remHook
+from anki.lang import ngettext
 import aqt.forms
 import aqt.modelchooser
 import aqt.deckchooser
@@ -157,6 +158,7 @@ you can enter it here. Use \\t to represent tab."""),
         self.mw.col.decks.select(did)
         self.mw.progress.start(immediate=True)
         self.mw.checkpoint(_("Import"))
+        addHook("importProgress", self.onProgress)
         try:
             self.importer.run()
         except UnicodeDecodeError:
@@ -174,6 +176,7 @@ you can enter it here. Use \\t to represent tab."""),
             showText(msg)
             return
         finally:
+            remHook("importProgress", self.onProgress)
             self.mw.progress.finish()
         txt = _("Importing complete.") + "\n"
         if self.importer.log:
@@ -182,6 +185,10 @@ you can enter it here. Use \\t to represent tab."""),
         showText(txt)
         self.mw.reset()
 
+    def onProgress(self, count):
+        self.mw.progress.update(ngettext(
+            "Processed %d note...", "Processed %d notes...", count) % count)
+
     def setupMappingFrame(self):
         # qt seems to have a bug with adding/removing from a grid, so we add
         # to a separate object and add/remove that instead
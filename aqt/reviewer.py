@@ -249,6 +249,8 @@ The front of this card is empty. Please run Tools>Empty Cards.""")
         a = self._mungeQA(a)
         self.web.eval("_updateQA(%s, true);" % json.dumps(a))
         self._showEaseButtons()
+        # load the next cards while the user reads the answer
+        self.mw.col.sched.prefetchCards()
         # user hook
         runHook('showAnswer')
 
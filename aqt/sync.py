@@ -462,6 +462,9 @@ httplib.HTTPConnection.send = _incrementalSend
 # - retries only when keep-alive connection is closed
 def _conn_request(self, conn, request_uri, method, body, headers):
     for i in range(2):
+        if hasattr(body, "seek"):
+            # a retry must send the whole body again
+            body.seek(0)
         try:
             if conn.sock is None:
               conn.connect()
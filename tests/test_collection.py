@@ -3,6 +3,8 @@
 import os, tempfile
 from tests.shared import assertException, getEmptyCol
 from anki.stdmodels import addBasicModel
+from anki.hooks import addHook, remHook
+import anki.hooks
 
 from anki import Collection as aopen
 
@@ -138,3 +140,67 @@ def test_furigana():
     m['tmpls'][0]['qfmt'] = '{{kana:}}'
     mm.save(m)
     c.q(reload=True)
+
+def test_renderQA():
+    deck = getEmptyCol()
+    deck.models.setCurrent(deck.models.byName("Cloze"))
+    for i in range(20):
+        n = deck.newNote()
+        n['Text'] = u"%d {{c1::one}} {{c2::two}}" % i
+        deck.addNote(n)
+    deck.models.setCurrent(deck.models.byName("Basic"))
+    for i in range(20):
+        n = deck.newNote()
+        n['Front'] = u"front %d" % i
+        n['Back'] = u"back[sound:%d.mp3]" % i
+        deck.addNote(n)
+    serial = deck.renderQA(type="all")
+    assert len(serial) == 60
+    # streaming in small chunks and rendering in other processes should
+    # give the same results in the same order
+    assert list(deck.iterRenderQA(type="all", chunk=7)) == serial
+    assert list(deck.iterRenderQA(type="all", chunk=7, processes=2)) == serial
+    # filters that can't be sent to other processes fall back to serial
+    addHook("fmod_upper", lambda txt, *args: txt.upper())
+    try:
+        assert deck._templateFilters() is None
+        assert list(deck.iterRenderQA(type="all", processes=2)) == serial
+    finally:
+        remHook("fmod_upper", anki.hooks._hooks["fmod_upper"][0])
+
+def test_genCards():
+    deck = getEmptyCol()
+    mm = deck.models
+    m = mm.current()
+    t = mm.newTemplate("Reverse")
+    t['qfmt'] = "{{Back}}"
+    t['afmt'] = "{{Front}}"
+    mm.addTemplate(m, t)
+    mm.save(m)
+    nids = []
+    for i in range(10):
+        n = deck.newNote()
+        n['Front'] = u"front %d" % i
+        if i % 2:
+            n['Back'] = u"back %d" % i
+        deck.addNote(n)
+        nids.append(n.id)
+    assert deck.cardCount() == 15
+    # remove the cards and regenerate them in one go
+    deck.remCards(deck.db.list("select id from cards"), notes=False)
+    pos = deck.conf['nextPos']
+    assert not deck.genCards(nids)
+    assert deck.cardCount() == 15
+    for nid in nids:
+        assert deck.db.scalar(
+            "select count() from cards where nid = ?", nid) in (1, 2)
+    # positions are allocated in a single block
+    assert sorted(deck.db.list("select due from cards")) == \
+        range(pos, pos+15)
+    assert deck.conf['nextPos'] == pos+15
+    # cards in a deck that no longer exists go to the default deck
+    m['tmpls'][1]['did'] = 12345
+    deck.remCards(deck.db.list("select id from cards where ord = 1"),
+                  notes=False)
+    deck.genCards(nids)
+    assert deck.db.list("select distinct did from cards") == [1]
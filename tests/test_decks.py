@@ -88,6 +88,33 @@ def test_rename():
     for n in "yo", "yo::two", "yo::two::three":
         assert n in d.decks.allNames()
 
+def test_index():
+    d = getEmptyCol()
+    def check():
+        # the index should agree with a scan of all decks
+        for g in d.decks.all():
+            kids = sorted((x['name'], x['id']) for x in d.decks.all()
+                          if x['name'].startswith(g['name'] + "::"))
+            assert sorted(d.decks.children(g['id'])) == kids
+            assert d.decks.id(g['name'].upper(), create=False) == g['id']
+            assert d.decks.byName(g['name']) == g
+    d.decks.id("one::two::three")
+    d.decks.id("One::four")
+    d.decks.id("five")
+    check()
+    assert [p['name'] for p in d.decks.parents(d.decks.id("one::two::three"))] \
+        == ["one", "one::two"]
+    d.decks.rename(d.decks.get(d.decks.id("one::two")), "five::two")
+    check()
+    assert d.decks.id("one::two::three", create=False) is None
+    d.decks.rem(d.decks.id("five"))
+    check()
+    assert d.decks.id("five::two::three", create=False) is None
+    # reloading rebuilds the same index
+    d.decks.flush()
+    d.load()
+    check()
+
 def test_renameForDragAndDrop():
     d = getEmptyCol()
 
@@ -272,3 +272,107 @@ def test_findDupes():
     assert not r
     # front isn't dupe
     assert deck.findDupes("Front") == []
+
+def test_searchIndexFields():
+    deck = getEmptyCol()
+    f = deck.newNote()
+    f['Front'] = u"horse"
+    f['Back'] = u"zebra"
+    deck.addNote(f)
+    if not deck.enableSearchIndex():
+        return
+    assert deck.findNotes("zebra") == [f.id]
+    # the index follows field removals and moves
+    m = deck.models.current()
+    deck.models.moveField(m, m['flds'][1], 0)
+    assert deck.findNotes("back:zebra") == [f.id]
+    deck.models.remField(m, m['flds'][0])
+    assert deck.findNotes("zebra") == []
+    assert deck.findNotes("horse") == [f.id]
+
+def test_searchIndex():
+    deck = getEmptyCol()
+    for front, back in ((u'dog', u'cat'), (u'<b>go</b>ats are fun', u'sheep'),
+                        (u'Ébc', u'a_b'), (u'12345', u'axb'),
+                        (u'hello world', u'50%')):
+        f = deck.newNote()
+        f['Front'] = front
+        f['Back'] = back
+        deck.addNote(f)
+    searches = ("cat", "goats", "go*ts", u"ébc", u"ÉBC", "a_b", "234", "o",
+                "front:dog", "back:a_b", "front:*ll*", "back:50\\%",
+                "back:sh*", "-sheep", "dog or sheep", "a\\_b")
+    def results():
+        return [sorted(deck.findNotes(s)) for s in searches]
+    plain = results()
+    if not deck.enableSearchIndex():
+        # sqlite lacks fts5 trigram support
+        return
+    assert deck.hasSearchIndex()
+    assert "notesfts" in Finder(deck)._findText("cat", [])
+    assert results() == plain
+    # the index follows edits, find&replace and deletions
+    f = deck.getNote(deck.findNotes("cat")[0])
+    f['Back'] = u'mouse'
+    f.flush()
+    assert deck.findNotes("mouse") == [f.id]
+    assert not deck.findNotes("cat")
+    deck.findReplace([f.id], "mouse", "rat")
+    assert deck.findNotes("rat") == [f.id]
+    deck.remNotes([f.id])
+    assert not deck.findNotes("rat")
+    # and survives reopening and rebuilding
+    deck.close()
+    deck.reopen()
+    deck.load()
+    assert deck.hasSearchIndex()
+    assert deck.findNotes("sheep")
+    deck.db.execute("delete from notesfts")
+    deck.fixIntegrity()
+    assert deck.findNotes("sheep")
+    deck.disableSearchIndex()
+    assert not deck.hasSearchIndex()
+    assert deck.findNotes("sheep")
+
+def test_findCache():
+    deck = getEmptyCol()
+    f = deck.newNote()
+    f['Front'] = u'dog'
+    f['Back'] = u'cat'
+    deck.addNote(f)
+    cache = deck.findCache
+    assert len(deck.findCards("dog is:new")) == 1
+    assert len(cache.queries) == 1 and len(cache.results) == 1
+    # repeated searches hit both caches
+    assert len(deck.findCards("dog is:new")) == 1
+    assert len(cache.queries) == 1 and len(cache.results) == 1
+    # results are dropped once the db changes
+    f2 = deck.newNote()
+    f2['Front'] = u'dog'
+    deck.addNote(f2)
+    assert len(deck.findCards("dog is:new")) == 2
+    assert len(cache.queries) == 1 and len(cache.results) == 1
+    # callers can't modify cached results
+    deck.findCards("dog").pop()
+    assert len(deck.findCards("dog")) == 2
+    # results are kept under a total number of ids
+    assert cache.resultIds == 4
+    cache.idLimit = 3
+    assert len(deck.findCards("dog or cat")) == 2
+    assert len(cache.results) == 1 and cache.resultIds == 2
+    assert len(deck.findCards("is:new")) == 2
+    assert len(cache.results) == 1 and cache.resultIds == 2
+    cache.idLimit = 1
+    assert len(deck.findCards("front:dog or cat")) == 2
+    assert len(cache.results) == 1 and cache.resultIds == 2
+    # deck names and fields can change without a db write, so those
+    # queries are always recompiled
+    cache.clear()
+    deck.findCards("deck:default front:dog")
+    assert not cache.queries
+    deck.decks.rename(deck.decks.get(1), "foo")
+    assert not deck.findCards("deck:default")
+    assert len(deck.findCards("deck:foo")) == 2
+    assert len(deck.findNotes("front:dog")) == 2
+    deck.rollback()
+    assert not cache.queries and not cache.results
@@ -1,9 +1,10 @@
 # coding: utf-8
 
-import  os
-from tests.shared import  getUpgradeDeckPath, getEmptyCol
+import  os, time, zipfile, tempfile
+from tests.shared import  getUpgradeDeckPath, getEmptyCol, assertException
 from anki.upgrade import Upgrader
-from anki.utils import ids2str
+from anki.hooks import addHook, remHook
+from anki.utils import ids2str, fieldChecksum
 from anki.importing import Anki1Importer, Anki2Importer, TextImporter, \
     SupermemoXmlImporter, MnemosyneImporter, AnkiPackageImporter
 
@@ -113,6 +114,67 @@ def test_apkg():
     imp.run()
     assert len(os.listdir(tmp.media.dir())) == 2
 
+def _test_apkgMemory():
+    # build a package holding a large collection
+    src = getEmptyCol()
+    src.db.execute("create table pad (data)")
+    for i in range(200):
+        src.db.execute("insert into pad values (randomblob(1024*1024))")
+    src.close()
+    apkg = src.path.replace(".anki2", ".apkg")
+    z = zipfile.ZipFile(apkg, "w", zipfile.ZIP_STORED, allowZip64=True)
+    z.write(src.path, "collection.anki2")
+    z.writestr("media", "{}")
+    z.close()
+    os.unlink(src.path)
+    # import it, noting how much the peak memory use grows
+    import resource
+    tmp = getEmptyCol()
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    t = time.time()
+    AnkiPackageImporter(tmp, unicode(apkg)).run()
+    grew = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before
+    print "import %dms, peak rss grew %dkb" % ((time.time() - t)*1000, grew)
+    assert grew < 50*1024
+    os.unlink(apkg)
+
+def test_anki2_clashes():
+    # a source note and card whose ids are taken in the destination
+    src = getEmptyCol()
+    n = src.newNote()
+    n['Front'] = u"src"
+    src.addNote(n)
+    c = n.cards()[0]
+    c.startTimer()
+    src.sched.answerCard(c, 3)
+    src.close()
+    dst = getEmptyCol()
+    n2 = dst.newNote()
+    n2['Front'] = u"dst"
+    dst.addNote(n2)
+    dst.db.execute("update notes set id = ?", n.id)
+    dst.db.execute("update cards set id = ?, nid = ?", c.id, n.id)
+    imp = Anki2Importer(dst, src.path)
+    imp.vacuum = False
+    imp.run()
+    assert dst.noteCount() == 2
+    nid = dst.db.scalar("select id from notes where sfld = 'src'")
+    assert nid == n.id + 999
+    cid = dst.db.scalar("select id from cards where nid = ?", nid)
+    assert cid == c.id + 999
+    # the review history follows the card
+    assert dst.db.list("select cid from revlog") == [cid]
+    # importing again adds nothing
+    imp = Anki2Importer(dst, src.path)
+    imp.run()
+    assert dst.noteCount() == 2
+    assert dst.cardCount() == 2
+    assert dst.db.scalar("select count() from revlog") == 1
+    # and leaves nothing behind
+    assert not dst.db.scalar("select 1 from sqlite_temp_master "
+                             "where name like 'imp%'")
+    assert "src" not in [r[1] for r in dst.db.all("pragma database_list")]
+
 def test_anki1():
     # get the deck path to import
     tmp = getUpgradeDeckPath()
@@ -286,6 +348,79 @@ def test_csv():
     assert deck.cardCount() == 11
     deck.close()
 
+def test_csv_checksums():
+    deck = getEmptyCol()
+    n = deck.newNote()
+    n['Front'] = u"foo"; n['Back'] = u"old"
+    deck.addNote(n)
+    # a note whose checksum matches but first field doesn't
+    n2 = deck.newNote()
+    n2['Front'] = u"bar"; n2['Back'] = u"old"
+    deck.addNote(n2)
+    deck.db.execute("update notes set csum = ?", fieldChecksum(u"foo"))
+    (fd, path) = tempfile.mkstemp(suffix=".txt")
+    os.write(fd, "foo\tnew\nbaz\tnew\n")
+    os.close(fd)
+    i = TextImporter(deck, unicode(path))
+    i.initMapping()
+    i.run()
+    os.unlink(path)
+    assert i.updateCount == 1
+    n.load(); n2.load()
+    assert n['Back'] == "new"
+    assert n2['Back'] == "old"
+    assert deck.noteCount() == 3
+    assert len(i._notesByChecksum([fieldChecksum(u"foo")]).values()[0]) == 2
+    deck.close()
+
+def test_csv_batches():
+    deck = getEmptyCol()
+    (fd, path) = tempfile.mkstemp(suffix=".txt")
+    os.write(fd, "tags:imported\n# comment\n")
+    for i in range(25):
+        os.write(fd, "front%d\tback\n" % i)
+    # a duplicate in a later batch
+    os.write(fd, "front3\tback\n")
+    os.close(fd)
+    i = TextImporter(deck, unicode(path))
+    i.initMapping()
+    i.batchSize = 10
+    seen = []
+    addHook("importProgress", seen.append)
+    try:
+        i.run()
+    finally:
+        remHook("importProgress", seen.append)
+    assert seen == [10, 20, 26]
+    assert i.total == 25
+    assert deck.noteCount() == 25
+    assert "Appeared twice in file: front3" in i.log
+    assert deck.db.scalar("select count() from notes where tags = ' imported '") == 25
+    # notes from earlier batches aren't reported as duplicates of the deck
+    deck3 = getEmptyCol()
+    i = TextImporter(deck3, unicode(path))
+    i.initMapping()
+    i.batchSize = 10
+    i.importMode = 2
+    i.run()
+    os.unlink(path)
+    assert deck3.noteCount() == 26
+    assert not [l for l in i.log if l.startswith("Added duplicate")]
+    # a bad line after the first batch leaves nothing imported
+    deck2 = getEmptyCol()
+    (fd, path) = tempfile.mkstemp(suffix=".txt")
+    for n in range(15):
+        os.write(fd, "new%d\tback\n" % n)
+    os.write(fd, "caf\xe9\tback\n")
+    os.close(fd)
+    i = TextImporter(deck2, unicode(path))
+    i.initMapping()
+    i.batchSize = 10
+    assertException(UnicodeDecodeError, i.run)
+    os.unlink(path)
+    assert deck2.noteCount() == 0
+    deck.close()
+
 def test_csv2():
     deck = getEmptyCol()
     mm = deck.models
@@ -323,6 +458,39 @@ def test_supermemo_xml_01_unicode():
     assert c.reps == 7
     deck.close()
 
+def test_supermemo_xml_batches():
+    deck = getEmptyCol()
+    (fd, path) = tempfile.mkstemp(suffix=".xml")
+    items = "".join("""
+<SuperMemoElement><ID>%d</ID><Type>Item</Type>
+<Content><Question>q%d</Question><Answer>a%d</Answer></Content>
+</SuperMemoElement>""" % (i, i, i) for i in range(25))
+    os.write(fd, """<?xml version="1.0" encoding="UTF-8"?>
+<SuperMemoCollection><Count>26</Count>
+<SuperMemoElement><ID>1</ID><Title>Topic One</Title><Type>Topic</Type>%s
+</SuperMemoElement>
+<SuperMemoElement><ID>2</ID><Type>Item</Type>
+<Content><Question>untagged</Question><Answer>a</Answer></Content>
+</SuperMemoElement>
+</SuperMemoCollection>""" % items)
+    os.close(fd)
+    i = SupermemoXmlImporter(deck, unicode(path))
+    i.batchSize = 10
+    seen = []
+    addHook("importProgress", seen.append)
+    try:
+        i.run()
+    finally:
+        remHook("importProgress", seen.append)
+    os.unlink(path)
+    assert seen == [10, 20, 26]
+    assert i.total == 26
+    # items are tagged with the topics they were in when parsed
+    assert len(deck.findNotes("tag:topicOne")) == 25
+    assert deck.findNotes("untagged")
+    assert not deck.findNotes("untagged tag:topicOne")
+    deck.close()
+
 def test_mnemo():
     deck = getEmptyCol()
     file = unicode(os.path.join(testDir, "support/mnemo.db"))
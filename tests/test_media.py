@@ -5,6 +5,7 @@ import os
 import time
 
 from shared import getEmptyCol, testDir
+from anki.utils import checksum
 
 
 # copying files to media folder
@@ -115,3 +116,126 @@ def test_illegal():
             assert(c not in good)
         else:
             assert(c in good)
+
+def test_scanStats():
+    d = getEmptyCol()
+    names = []
+    for i in range(10):
+        path = os.path.join(d.media.dir(), u"file%d.txt" % i)
+        open(path, "w").write("data %d" % i)
+        names.append(os.path.basename(path))
+    d.media.findChanges()
+    csums = dict(d.media.db.execute(
+        "select fname, csum from media where csum is not null"))
+    assert sorted(csums) == names
+    # checksums from the thread pool match a serial run
+    for f in names:
+        assert csums[f] == d.media._checksum(f)
+    assert d.media.db.scalar("select count() from stats") == 10
+    # an edit that keeps the mtime is caught by the size change
+    path = names[0]
+    mtime = os.stat(path).st_mtime
+    open(path, "w").write("different data")
+    os.utime(path, (mtime, mtime))
+    d.media.db.execute("update media set dirty = 0")
+    d.media.db.execute("update meta set dirMod = 0")
+    d.media.findChanges()
+    assert d.media.db.list("select fname from media where dirty = 1") == [
+        path]
+    # and removed files are dropped from the stats
+    os.unlink(names[1])
+    d.media.db.execute("update meta set dirMod = 0")
+    d.media.findChanges()
+    assert d.media.db.scalar("select count() from stats") == 9
+    # a touched file with the same contents is only checksummed once
+    checked = []
+    checksums = d.media._checksums
+    def countingChecksums(files):
+        checked.extend(files)
+        return checksums(files)
+    d.media._checksums = countingChecksums
+    path = names[2]
+    mtime = os.stat(path).st_mtime + 10
+    os.utime(path, (mtime, mtime))
+    for i in range(3):
+        d.media.db.execute("update meta set dirMod = 0")
+        d.media.findChanges()
+    assert checked == [path]
+    assert not d.media.db.scalar(
+        "select dirty from media where fname = ?", path)
+
+def test_checksumFile():
+    from cStringIO import StringIO
+    from anki.utils import checksum, checksumFile, CHUNK_SIZE
+    data = "".join(chr(i % 256) for i in range(CHUNK_SIZE*2 + 100))
+    path = os.path.join(tempfile.mkdtemp(prefix="anki"), "data")
+    open(path, "wb").write(data)
+    # paths and file-like objects match the in-memory checksum
+    assert checksumFile(path) == checksum(data)
+    out = StringIO()
+    assert checksumFile(StringIO(data), out) == checksum(data)
+    assert out.getvalue() == data
+
+def test_refs():
+    d = getEmptyCol()
+    def scanned():
+        refs = set()
+        for nid, mid, flds in d.db.execute("select id, mid, flds from notes"):
+            for f in d.media.filesInStr(mid, flds, latex=False):
+                refs.add((nid, f))
+        return refs
+    def stored():
+        return set(d.db.all("select nid, fname from mediarefs"))
+    f = d.newNote()
+    f['Front'] = u"<img src='one.png'>[sound:two.mp3]"
+    d.addNote(f)
+    f2 = d.newNote()
+    f2['Front'] = u"<img src='one.png'>"
+    f2['Back'] = u"<img src='http://example.com/remote.png'>"
+    d.addNote(f2)
+    assert not d.media.haveRefs()
+    # checking media creates the table
+    assert sorted(d.media.check()[0]) == ["one.png", "two.mp3"]
+    assert d.media.haveRefs()
+    assert stored() == scanned()
+    # and it's kept up to date from here on
+    f['Back'] = u"<img src='three.png'>"
+    f.flush()
+    assert stored() == scanned()
+    d.findReplace([f.id, f2.id], "one.png", "four.png")
+    assert stored() == scanned()
+    assert sorted(d.media.filesInNotes([f2.id])) == ["four.png"]
+    d.remNotes([f.id])
+    assert stored() == scanned()
+    assert d.media.check()[0] == ["four.png"]
+    # as are field changes
+    f2.load()
+    f2['Back'] = u"<img src='five.png'>"
+    f2.flush()
+    m = d.models.current()
+    d.models.remField(m, m['flds'][1])
+    assert stored() == scanned()
+    assert d.media.check()[0] == ["four.png"]
+    # rebuilding gives the same result
+    d.db.execute("delete from mediarefs")
+    d.fixIntegrity()
+    assert stored() == scanned()
+    # latex isn't rendered when notes are saved
+    import anki.latex
+    built = []
+    buildImg = anki.latex._buildImg
+    anki.latex._buildImg = lambda *args: built.append(args)
+    try:
+        f3 = d.newNote()
+        f3['Front'] = u"[latex]hello[/latex]"
+        d.addNote(f3)
+        assert not built
+        assert stored() == scanned()
+        # but its images are still in use when checking
+        open(u"latex-%s.png" % checksum("hello"), "w").write("png")
+        assert d.media.check()[:2] == (["four.png"], [])
+        assert not built
+        assert u"latex-%s.png" % checksum("hello") in \
+            d.media.filesInNotes([f3.id])
+    finally:
+        anki.latex._buildImg = buildImg
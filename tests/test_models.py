@@ -2,6 +2,7 @@
 
 from tests.shared import getEmptyCol
 from anki.utils import stripHTML, joinFields
+import anki.hooks
 
 def test_modelDelete():
     deck = getEmptyCol()
@@ -308,3 +309,30 @@ def test_availOrds():
     t['Front'] = ""
     t['Back'] = "1"
     assert mm.availOrds(m, joinFields(f.fields)) == [0]
+
+def test_reqFromTemplate():
+    d = getEmptyCol()
+    m = d.models.current(); mm = d.models
+    t = m['tmpls'][0]
+    flds = mm.fieldNames(m)
+    for fmt in ("{{Front}}", "{{Back}}", "{{Front}}{{Back}}",
+                "{{#Front}}{{#Back}}{{Front}}{{/Back}}{{/Front}}",
+                "{{^Front}}{{Back}}{{/Front}}", "{{text:Front}}",
+                "{{hint:Back}}", "{{type:Front}}{{Back}}", "{{Missing}}",
+                "{{Tags}}{{#Front}}x{{/Front}}", "{{kana:Front}}",
+                "{{#Back}}{{/Back}}static"):
+        t['qfmt'] = fmt
+        assert mm._reqFromTemplate(m, flds, t) == \
+            mm._reqForTemplate(m, flds, t), fmt
+    # latex gets rendered, so falls back to the slow path
+    t['qfmt'] = "[latex]{{Front}}[/latex]"
+    assert mm._reqFromTemplate(m, flds, t) is None
+    # and so do unknown filters
+    def upper(txt, *args):
+        return txt.upper()
+    anki.hooks.addHook("fmod_upper", upper)
+    try:
+        t['qfmt'] = "{{Front}}"
+        assert mm._reqFromTemplate(m, flds, t) is None
+    finally:
+        anki.hooks.remHook("fmod_upper", upper)
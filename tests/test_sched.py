@@ -967,6 +967,111 @@ def test_deckDue():
     d.sched.deckDueList()
     d.sched.deckDueTree()
 
+def test_deckDueCache():
+    d = getEmptyCol()
+    d.conf['newSpread'] = 2
+    for i, name in enumerate(("Default", "Default::a", "foo::bar", "foo::baz")):
+        did = d.decks.id(name)
+        for j in range(i+2):
+            f = d.newNote()
+            f['Front'] = u"%s %d" % (name, j)
+            f.model()['did'] = did
+            d.addNote(f)
+    def uncached():
+        d.sched._clearDeckCounts()
+        return d.sched.deckDueList()
+    d.reset()
+    assert d.sched.deckDueList() == uncached()
+    first = d.sched.deckDueList()
+    # answering a card only dirties the decks it touched
+    c = d.sched.getCard()
+    d.sched.answerCard(c, 1)
+    assert d.sched._dueCache['dirty'] == set([c.did])
+    cached = d.sched.deckDueList()
+    assert cached != first
+    assert cached == uncached()
+    # card flushes are tracked too, including moves between decks
+    d.sched.deckDueList()
+    c.did = d.decks.id("foo::baz")
+    c.flush()
+    assert d.sched.deckDueList() == uncached()
+    # and other changes cause a full recount
+    d.sched.deckDueList()
+    d.sched.suspendCards([c.id])
+    assert d.sched.deckDueList() == uncached()
+    # rolling back discards the cache
+    d.save()
+    d.sched.deckDueList()
+    d.db.execute("update cards set queue = -1")
+    d.sched.deckDueList()
+    d.rollback()
+    assert d.sched.deckDueList() == uncached()
+
+def test_walkingCountBatched():
+    d = getEmptyCol()
+    # a parent with many active subdecks and a limit they share
+    parent = d.decks.id("parent")
+    conf = d.decks.confForDid(parent)
+    conf['new']['perDay'] = 500
+    d.decks.save(conf)
+    for i in range(300):
+        did = d.decks.id("parent::%03d" % i)
+        for j in range(3):
+            f = d.newNote()
+            f['Front'] = u"%d %d" % (i, j)
+            f.model()['did'] = did
+            d.addNote(f)
+    d.decks.select(parent)
+    cntFn = lambda did, lim: d.db.scalar("""
+select count() from (select 1 from cards where
+did = ? and queue = 0 limit ?)""", did, lim)
+    lim = d.sched._deckNewLimitSingle
+    # count the queries each way takes
+    queries = []
+    execute = d.db.execute
+    def countingExecute(sql, *a, **ka):
+        queries.append(sql)
+        return execute(sql, *a, **ka)
+    d.db.execute = countingExecute
+    perDeck = d.sched._walkingCount(lim, cntFn)
+    perDeckQueries = len(queries)
+    del queries[:]
+    batched = d.sched._walkingCount(lim, cntSql="queue = 0")
+    del d.db.execute
+    assert perDeck == batched == 500
+    assert perDeckQueries >= 300
+    # one compound select per 250 decks
+    assert len(queries) == 2
+
+def test_prefetch():
+    d = getEmptyCol()
+    for i in range(5):
+        f = d.newNote()
+        f['Front'] = u"front%d" % i
+        d.addNote(f)
+    d.reset()
+    c = d.sched.getCard()
+    # nothing has been loaded ahead yet
+    assert not c._qa
+    d.sched.prefetchCards()
+    d.sched.answerCard(c, 3)
+    # answering keeps the prefetched cards
+    c = d.sched.getCard()
+    assert c._qa
+    assert c.q() == d.getCard(c.id).q()
+    assert c.note().fields == d.getNote(c.nid).fields
+    d.sched.prefetchCards()
+    d.sched.answerCard(c, 3)
+    # editing a note discards them
+    nxt = d.sched._newQueue[-1]
+    n = d.getCard(nxt).note()
+    n['Front'] = u"changed"
+    n.flush()
+    c = d.sched.getCard()
+    assert c.id == nxt
+    assert not c._qa
+    assert "changed" in c.q()
+
 def test_deckTree():
     d = getEmptyCol()
     d.decks.id("new::b::c")
@@ -3,9 +3,20 @@
 import nose, os, shutil, time
 
 from anki import Collection as aopen, Collection
-from anki.utils import intTime
-from anki.sync import Syncer, LocalServer
-from tests.shared import getEmptyCol, getEmptyDeckWith
+import zipfile
+import gzip
+import cgi
+import threading
+import BaseHTTPServer
+from cStringIO import StringIO
+
+from anki.utils import intTime, checksum, checksumFile, json
+from anki.sync import Syncer, LocalServer, MediaSyncer, HttpSyncer, \
+    _StreamingHttp, HttpPool, httplib2, SYNC_CHUNK_MIN, SYNC_CHUNK_BYTES, FullSyncer, \
+    LocalFullServer, blockSums, writeDelta, applyDelta
+from anki.hooks import addHook, remHook
+from anki.consts import SYNC_ZIP_COUNT
+from tests.shared import getEmptyCol, getEmptyDeckWith, assertException
 
 # Local tests
 ##########################################################################
@@ -314,6 +325,358 @@ def test_threeway2():
     assert n['Front'] == t2
     assert c1.db.scalar("select mod from cards") == 3
 
+@nose.with_setup(setup_modified)
+def test_chunkStats():
+    stats = []
+    def onStats(s):
+        stats.append(dict(s))
+    addHook("syncStats", onStats)
+    try:
+        assert client.sync() == "success"
+    finally:
+        remHook("syncStats", onStats)
+    assert stats
+    assert stats[-1] == client.stats
+    # both sides' cards, notes and revlog entries were counted
+    assert client.stats['rows'] >= 6
+    assert client.stats['rowsPerSec'] > 0
+    # chunks grow when fast and shrink when slow, within limits
+    client.chunkSize = 1000
+    rows = dict(cards=[None]*1000)
+    client._chunkSent(rows, 0, 0.1)
+    assert client.chunkSize == 2000
+    client._chunkSent(rows, 0, 100)
+    assert client.chunkSize == 1000
+    for i in range(10):
+        client._chunkSent(rows, 0, 100)
+    assert client.chunkSize == SYNC_CHUNK_MIN
+    # and stay under the size limit
+    client.chunkSize = 1000
+    client._chunkSent(rows, SYNC_CHUNK_BYTES, 0.1)
+    assert client.chunkSize == 1000
+
+class ChunkServer(HttpSyncer):
+    "Serves empty chunks, each with its own size."
+
+    def __init__(self, sizes):
+        HttpSyncer.__init__(self, con=object())
+        self.sizes = sizes
+
+    def chunk(self):
+        self.lastRecv = self.sizes.pop(0)
+        return dict(done=not self.sizes)
+
+@nose.with_setup(setup_basic)
+def test_chunkStatsPipelined():
+    # the next chunk may be fetched before this one's stats are recorded
+    seen = []
+    def onStats(s):
+        seen.append(s['bytes'])
+    addHook("syncStats", onStats)
+    try:
+        client.prepareToChunk()
+        client.server = ChunkServer([100, 200, 400])
+        client.streamFromServer()
+    finally:
+        remHook("syncStats", onStats)
+    assert seen == [100, 300, 700]
+
+@nose.with_setup(setup_basic)
+def test_mergeRows():
+    client.prepareToMerge()
+    card = deck1.db.first("select * from cards")
+    note = deck1.db.first("select * from notes")
+    # local changes are kept if incoming rows are older
+    old = list(card); old[4] = card[4] - 1; old[11] = 7
+    assert client.mergeRows([old], "cards") == []
+    assert deck1.db.scalar("select reps from cards") == card[11]
+    # and replaced if newer
+    new = list(card); new[4] = card[4] + 1; new[11] = 7
+    assert client.mergeRows([new], "cards") == [card[0]]
+    assert deck1.db.scalar("select reps from cards") == 7
+    # unknown rows are added, and their field cache is updated
+    n2 = list(note); n2[0] += 1; n2[1] = "abc"; n2[6] = u"baz\x1fqux"
+    client.mergeNotes([n2])
+    assert deck1.db.scalar("select sfld from notes where id = ?", n2[0]) == \
+        u"baz"
+    assert not deck1.db.scalar("select count() from temp.merge_notes")
+
+@nose.with_setup(setup_modified)
+def test_rowCounts():
+    def check(d):
+        rows = d.rowCounts()
+        for t in d.countedTables:
+            assert rows[t] == d.db.scalar("select count() from %s" % t)
+    assert client.sync() == "success"
+    check(deck1); check(deck2)
+    # the full check is skipped until it's due again
+    assert deck1.lastFullCheck
+    assert not client.fullCheckDue()
+    deck1.lastFullCheck = 0
+    assert client.fullCheckDue()
+    # replacing rows doesn't count them twice
+    deck1.db.execute("insert or replace into cards select * from cards")
+    check(deck1)
+    # and counts follow rollbacks
+    deck1.save()
+    deck1.remCards(deck1.db.list("select id from cards"))
+    check(deck1)
+    deck1.rollback()
+    check(deck1)
+    assert deck1.rowCounts()['cards'] == 2
+    # the triggers' changes don't invalidate the scheduler's caches
+    deck1.sched.deckDueList()
+    c = deck1.sched.getCard()
+    deck1.sched.prefetcher.prefetch([c.id])
+    c.flush()
+    assert deck1.sched._dueCacheValid()
+    assert deck1.sched.prefetcher.valid()
+    # and counting without them doesn't commit pending changes
+    d = getEmptyCol()
+    f = d.newNote()
+    f['Front'] = u"foo"
+    d.addNote(f)
+    assert d.rowCounts()['notes'] == 1
+    d.rollback()
+    assert d.noteCount() == 0
+
+def test_fullDelta():
+    col = getEmptyCol()
+    for i in range(500):
+        f = col.newNote()
+        f['Front'] = u"note %d" % i
+        f['Back'] = u"back %d " % i * 20
+        col.addNote(f)
+    # as after an earlier full sync
+    col.beforeUpload()
+    spath = col.path.replace(".anki2", "-server.anki2")
+    shutil.copy(col.path, spath)
+    server = LocalFullServer(spath)
+    # a small change is uploaded without sending the whole file
+    col = Collection(col.path)
+    f = col.newNote()
+    f['Front'] = u"new"
+    col.addNote(f)
+    client = FullSyncer(col, None, None, server=server)
+    assert client.upload()
+    assert checksumFile(spath) == checksumFile(col.path)
+    assert client.lastSent < os.path.getsize(spath) / 4
+    # and the other way
+    scol = Collection(spath)
+    scol.remNotes(scol.db.list("select id from notes limit 50"))
+    scol.close()
+    col = Collection(col.path)
+    client = FullSyncer(col, None, None, server=server)
+    client.download()
+    assert checksumFile(spath) == checksumFile(col.path)
+    col = Collection(col.path)
+    assert col.noteCount() == 451
+    col.close()
+    # patching the wrong file is caught
+    buf = StringIO()
+    writeDelta(col.path, blockSums(col.path), buf)
+    buf.seek(0)
+    open(spath, "wb").write("\0" * os.path.getsize(col.path))
+    assertException(Exception, lambda: applyDelta(spath, buf, spath + ".new"))
+    assert not os.path.exists(spath + ".new")
+    assert not os.path.exists(spath + ".new.part")
+    # as is a truncated delta
+    buf.seek(0)
+    buf = StringIO(buf.read(100))
+    assertException(Exception, lambda: applyDelta(col.path, buf,
+                                                  spath + ".new"))
+    assert not os.path.exists(spath + ".new")
+    assert not os.path.exists(spath + ".new.part")
+
+# Media syncing
+##########################################################################
+
+class LocalMediaServer(object):
+    "Stand-in for RemoteMediaServer, keeping files in memory."
+
+    def __init__(self, perZip=2, perBatch=5):
+        self.usn = 0
+        # fname -> (usn, csum, data)
+        self.files = {}
+        self.perZip = perZip
+        self.perBatch = perBatch
+
+    def begin(self):
+        return dict(usn=self.usn, sk="key")
+
+    def mediaChanges(self, lastUsn):
+        changes = sorted([usn, fname, csum] for fname, (usn, csum, data)
+                         in self.files.items() if usn > lastUsn)
+        return [[fname, usn, csum]
+                for usn, fname, csum in changes[:self.perBatch]]
+
+    def downloadFiles(self, files):
+        f = StringIO()
+        z = zipfile.ZipFile(f, "w")
+        meta = {}
+        for c, fname in enumerate(files[:self.perZip]):
+            z.writestr(str(c), self.files[fname][2])
+            meta[str(c)] = fname
+        z.writestr("_meta", json.dumps(meta))
+        z.close()
+        return f.getvalue()
+
+    def uploadChanges(self, data):
+        z = zipfile.ZipFile(StringIO(data))
+        meta = json.loads(z.read("_meta"))
+        for fname, zipname in meta:
+            self.usn += 1
+            if zipname:
+                fdata = z.read(zipname)
+                self.files[fname] = (self.usn, checksum(fdata), fdata)
+            else:
+                self.files[fname] = (self.usn, None, None)
+        return [len(meta), self.usn]
+
+    def mediaSanity(self, local):
+        have = len([f for f in self.files.values() if f[1]])
+        return "OK" if have == local else "FAILED"
+
+def test_media():
+    mserver = LocalMediaServer()
+    def msync(col):
+        # media operations are relative to the current folder
+        os.chdir(col.media.dir())
+        return MediaSyncer(col, mserver).sync()
+    def files(col):
+        return sorted(f for f in os.listdir(col.media.dir())
+                      if not f.startswith("."))
+    c1 = getEmptyCol()
+    c2 = getEmptyCol()
+    for i in range(SYNC_ZIP_COUNT + 5):
+        open(os.path.join(c1.media.dir(), "f%d.txt" % i), "w").write(
+            "data %d" % i)
+    assert msync(c1) == "OK"
+    assert len(mserver.files) == SYNC_ZIP_COUNT + 5
+    assert not c1.media.dirtyCount()
+    # the other client fetches them over several batches and zips
+    assert msync(c2) == "OK"
+    assert files(c2) == files(c1)
+    assert c2.media.lastUsn() == mserver.usn
+    assert not c2.media.dirtyCount()
+    assert msync(c2) == "noChanges"
+    # changes from the second client make it back to the first
+    time.sleep(1)
+    os.unlink(os.path.join(c2.media.dir(), "f0.txt"))
+    open(os.path.join(c2.media.dir(), "new.txt"), "w").write("new")
+    assert msync(c2) == "OK"
+    assert msync(c1) == "OK"
+    assert files(c1) == files(c2)
+    assert "f0.txt" not in files(c1) and "new.txt" in files(c1)
+
+# HTTP
+##########################################################################
+
+class LoopbackHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    "Echoes back the posted data, gzipped."
+
+    def do_POST(self):
+        form = cgi.FieldStorage(fp=self.rfile, headers=self.headers,
+                                environ=dict(REQUEST_METHOD="POST"))
+        data = form['data'].value
+        if form['c'].value == "1":
+            data = gzip.GzipFile(fileobj=StringIO(data)).read()
+        buf = StringIO()
+        z = gzip.GzipFile(mode="wb", fileobj=buf)
+        z.write(data)
+        z.close()
+        self.send_response(200)
+        self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(buf.tell()))
+        self.end_headers()
+        self.wfile.write(buf.getvalue())
+
+    def log_message(self, *args):
+        pass
+
+class LoopbackSyncer(HttpSyncer):
+
+    def syncURL(self):
+        return "http://127.0.0.1:%d/" % self.port
+
+def test_httpStreaming():
+    httpd = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), LoopbackHandler)
+    t = threading.Thread(target=httpd.serve_forever)
+    t.daemon = True
+    t.start()
+    try:
+        data = "".join(str(i) for i in range(200000))
+        for con in _StreamingHttp(), httplib2.Http():
+            s = LoopbackSyncer(con=con)
+            s.port = httpd.server_address[1]
+            # the body goes via a temp file, in both directions
+            assert s.req("echo", StringIO(data)) == data
+            assert s.req("echo", StringIO(data), comp=0) == data
+            out = StringIO()
+            assert s.req("echo", StringIO(data), out=out) == ""
+            assert out.getvalue() == data
+    finally:
+        httpd.shutdown()
+
+class KeepAliveHandler(LoopbackHandler):
+    protocol_version = "HTTP/1.1"
+
+class DroppingHandler(LoopbackHandler):
+    "Closes the connection without replying to the first request."
+    dropped = False
+
+    def do_POST(self):
+        if DroppingHandler.dropped:
+            return LoopbackHandler.do_POST(self)
+        DroppingHandler.dropped = True
+        self.rfile.read(int(self.headers['Content-Length']))
+        self.close_connection = 1
+
+def test_httpStreamingRetry():
+    httpd = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), DroppingHandler)
+    t = threading.Thread(target=httpd.serve_forever)
+    t.daemon = True
+    t.start()
+    recv = []
+    addHook("httpRecv", recv.append)
+    try:
+        s = LoopbackSyncer(con=_StreamingHttp())
+        s.port = httpd.server_address[1]
+        data = "".join(str(i) for i in range(200000))
+        out = StringIO()
+        # the retry sends the whole body again
+        assert s.req("echo", StringIO(data), comp=0, out=out) == ""
+        assert out.getvalue() == data
+        assert DroppingHandler.dropped
+        # and progress is reported as the response arrives
+        assert recv and sum(recv) < len(data)
+    finally:
+        remHook("httpRecv", recv.append)
+        httpd.shutdown()
+
+def test_httpPool():
+    httpd = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), KeepAliveHandler)
+    t = threading.Thread(target=httpd.serve_forever)
+    t.daemon = True
+    t.start()
+    pool = HttpPool(size=1, factory=_StreamingHttp)
+    try:
+        s = LoopbackSyncer(con=pool)
+        s.port = httpd.server_address[1]
+        for i in range(3):
+            assert s.req("echo", StringIO("foo")) == "foo"
+        # one connection, kept alive between requests
+        assert pool.stats() == [dict(requests=3, reused=2)]
+        # idle connections are reopened
+        pool.idle = -1
+        out = StringIO()
+        assert s.req("echo", StringIO("bar"), out=out) == ""
+        assert out.getvalue() == "bar"
+        assert pool.stats() == [dict(requests=4, reused=2)]
+    finally:
+        pool.close()
+        httpd.shutdown()
+
 def _test_speed():
     t = time.time()
     deck1 = aopen(os.path.expanduser("~/rapid.anki"))
@@ -0,0 +1,94 @@
+# coding: utf-8
+
+import time
+
+from anki.template import Template, render
+
+def legacy(template, context):
+    t = Template(template, context)
+    return t.render_tags(t.render_sections(template, context), context)
+
+templates = [
+    u"{{Front}}",
+    u"{{Front}} and {{Front}} <b>{{Back}}</b>",
+    u"{{#Back}}has back: {{Back}}{{/Back}}{{^Back}}no back{{/Back}}",
+    u"{{#Front}}{{#Back}}both{{/Back}}{{/Front}}",
+    u"{{text:Front}}",
+    u"{{hint:Back}}",
+    u"{{furigana:Back}} {{kana:Back}} {{kanji:Back}}",
+    u"{{type:Back}}",
+    u"{{cq-1:Text}}",
+    u"{{ca-2:text:Text}}",
+    u"{{#cq:1:Text}}has c1{{/cq:1:Text}}{{^cq:3:Text}}no c3{{/cq:3:Text}}",
+    u"{{! a comment }}{{Front}}",
+    u"{{Missing}} {{foo:Front}}",
+    u"{{{Front}}}",
+    u"{{#Front}}{{/Front}}",
+    u"<script>function f() { return {a: 1}; }</script>{{Front}}",
+    u"{{=<% %>=}}<%Front%>",
+    u"{{#Front}}{{#Back}}{{/Front}}x{{/Back}}",
+    u"{{#Back}}a{{#Back}}b{{/Back}}c{{/Back}}",
+    u"{{&Front}} {{Back}}",
+    u"{{Back}}{ {{Front}}",
+]
+
+contexts = [
+    dict(Front=u"hello", Back=u"日本[にほん]", Text=u"{{c1::one}} {{c2::two}}"),
+    dict(Front=u"<b>bold</b>", Back=u"", Text=u""),
+    dict(Front=u"", Back=u"<img src=a.jpg>", Text=u"x {{c3::three::hint}}"),
+    dict(Front=u"has {{Back}} braces", Back=u"b", Text=u"{{c1::a}}"),
+    dict(Front=u" &nbsp;", Back=u"  <br> x", Text=u"{"),
+]
+
+def test_compiled():
+    for template in templates:
+        for context in contexts:
+            # twice, so the second render comes from the cache
+            for i in range(2):
+                try:
+                    expected = legacy(template, context)
+                except Exception, e:
+                    expected = e.__class__
+                try:
+                    got = render(template, context)
+                except Exception, e:
+                    got = e.__class__
+                assert got == expected, (template, context, got, expected)
+
+def test_compileOnce():
+    from anki.template import template as tmod
+    template = u"{{#Front}}<b>{{Front}}</b>{{/Front}} {{text:Back}}"
+    tmod._compiled.clear()
+    compiled = []
+    compile = Template.compile
+    def countingCompile(self, template):
+        compiled.append(template)
+        return compile(self, template)
+    Template.compile = countingCompile
+    try:
+        for context in contexts:
+            for i in range(3):
+                assert render(template, context) == legacy(template, context)
+    finally:
+        Template.compile = compile
+    # parsed once, along with the section's contents, and all renders walk
+    # the cached nodes
+    assert compiled == [template, u"<b>{{Front}}</b>"]
+    assert tmod._compiled[template] is not None
+
+def _test_speed():
+    # a note type with many fields, each shown in its own section
+    names = ["Field%d" % i for i in range(30)]
+    template = u"\n".join(
+        u"{{#%s}}<div class=f%d><span>%s:</span> {{%s}}</div>{{/%s}}" % (
+            n, i, n, n, n) for i, n in enumerate(names))
+    context = dict((n, u"some <i>content</i> " * 50) for n in names)
+    t = time.time()
+    for i in range(100):
+        legacy(template, context)
+    old = time.time() - t
+    t = time.time()
+    for i in range(100):
+        render(template, context)
+    new = time.time() - t
+    print "template rendering: old %0.3fs, compiled %0.3fs" % (old, new)